@@ -2,19 +2,18 @@ import io
 import cv2
 import secrets 
 import numpy as np
-import faiss
 from flask import Flask, json, jsonify, render_template, request, redirect, url_for, flash, send_file, session, Response, abort
 from functools import wraps
-import psycopg2
-import psycopg2.extras
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_mail import Mail, Message
 from PIL import Image as PILImage 
 import traceback
 import re
 import database as db 
-from ml_utils import MLModel
+from ml_utils import MLModel, range_search, max_search_results
 from pdf_extractor import UltraRobustExtractor, extract_all 
+from ingest_pipeline import JournalIngestPipeline
+from index_registry import TargetIndexRegistry
 from reportlab.lib.pagesizes import A4
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image as RLImage, Table, TableStyle
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
@@ -22,6 +21,7 @@ from reportlab.lib import colors
 import imagehash
 from difflib import SequenceMatcher
 import os
+import threading
 from dotenv import load_dotenv
 from pathlib import Path
 
@@ -55,8 +55,37 @@ app.config['MAIL_DEFAULT_SENDER'] = (
 mail = Mail(app)
 
 # --- INITIALIZE THE MODELS ---
+# Models and the logo index load in a background thread; ML routes answer 503 until ready.
+# Set ML_WARMUP=False for CLI tools that import app but never embed anything.
 ml_model = MLModel()
-ml_model.build_logo_index() 
+db.register_write_listener(ml_model.apply_db_changes)  # inserts / deletes patch the FAISS indexes in place
+
+# Per-target comparison indexes, rebuilt only after a write to that target
+target_indexes = TargetIndexRegistry()
+db.register_write_listener(target_indexes.on_db_write)
+
+def resync_indexes():
+    """Change events were missed while the listener was disconnected: diff against the DB again."""
+    target_indexes.invalidate()
+    ml_model.check_index_consistency()
+
+_services_lock   = threading.Lock()
+_change_listener = None
+
+def start_background_services():
+    """
+    Change listener + model warm-up. Other workers' writes arrive as Postgres NOTIFY events and go
+    through the same listeners; only worth a connection and a thread once this process has indexes.
+    """
+    global _change_listener
+    with _services_lock:
+        if _change_listener is None and os.getenv('DB_CHANGE_LISTENER', 'True') == 'True':
+            _change_listener = db.start_change_listener(on_resync=resync_indexes)
+    ml_model.start_warmup()
+
+# With ML_WARMUP=False (CLI tools) both start on the first ML request instead, see ml_required
+if os.getenv('ML_WARMUP', 'True') == 'True':
+    start_background_services()
 
 # ===============================================================================================
 # AUTHENTICATION DECORATORS & BASIC ROUTES
@@ -72,6 +101,25 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def ml_required(need_index=False):
+    """Answers 503 while the background warm-up is still loading models (and the logo index)."""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not ml_model.is_ready(need_index=need_index):
+                if ml_model.model_state == 'not_loaded' and os.getenv('ML_WARMUP', 'True') != 'True':
+                    start_background_services()
+                message = 'AI models are still loading. Please try again shortly.'
+                return jsonify({
+                    'success': False,
+                    'error':   message,
+                    'message': message,
+                    'status':  ml_model.status()
+                }), 503
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -265,6 +313,7 @@ def client_dataset():
 
 @app.route('/upload-journal/<category>', methods=['POST'])
 @admin_required 
+@ml_required()
 def upload_journal(category):
     file  = request.files.get('file')
     batch = request.form.get('batch_number')
@@ -277,47 +326,30 @@ def upload_journal(category):
 
     def generate():
         try:
-            raw_data  = []
-            extractor = UltraRobustExtractor() 
-
-            for update in extractor.extract_all(io.BytesIO(file_bytes)):
-                status = update.get('status')
-                if status == 'extracting':
-                    yield json.dumps(update) + "\n"
-                elif status == 'extraction_complete':
-                    raw_data = update.get('results', [])
-
-            total_records = len(raw_data)
-            if total_records == 0:
-                yield json.dumps({"status": "error", "message": "No trademarks found in PDF."}) + "\n"
-                return
+            pipeline = JournalIngestPipeline(
+                UltraRobustExtractor(),
+                ml_model,
+                {'category': category, 'batch_number': batch, 'batch_year': year}
+            )
 
+            failed   = False
             inserted = 0
-            for tm in raw_data:
-                if tm.get("block_snapshot") and not tm.get("evidence_snapshot"):
-                    tm["evidence_snapshot"] = tm["block_snapshot"]
-
-                tm.update({'category': category, 'batch_number': batch, 'batch_year': year})
-
-                combined_text = f"{tm.get('trademark_name','')} {tm.get('description','')}".strip()
-                if combined_text:
-                    tm['text_embedding'] = ml_model.generate_text_embedding(combined_text)
-
-                if tm.get('logo_data'):
-                    tm['logo_embedding'] = ml_model.generate_image_embedding(io.BytesIO(tm['logo_data']))
-
-                db.insert_trademark(tm)
-                inserted += 1
-
-                db_percent = int((inserted / total_records) * 100)
-                yield json.dumps({
-                    "status":     "inserting", 
-                    "percentage": db_percent, 
-                    "current":    inserted, 
-                    "total":      total_records
-                }) + "\n"
+            for event in pipeline.run(file_bytes):
+                status = event.get('status')
+                if status == 'finished':
+                    inserted = event['inserted']
+                    continue
+                if status == 'error':
+                    failed = True
+                yield json.dumps(event) + "\n"
+
+            # No rebuild needed: every insert already reached the indexes via the DB write listener
+            if failed:
+                return
+            if inserted == 0:
+                yield json.dumps({"status": "error", "message": "No trademarks found in PDF."}) + "\n"
+                return
 
-            ml_model.build_logo_index()
             yield json.dumps({
                 "status":  "complete", 
                 "success": True, 
@@ -336,6 +368,7 @@ def upload_journal(category):
 
 @app.route('/upload-client-dataset', methods=['POST'])
 @admin_required
+@ml_required()
 def upload_client_dataset():
     file           = request.files.get('file')
     user_file_name = request.form.get('user_file_name', 'Unnamed')
@@ -356,16 +389,14 @@ def upload_client_dataset():
                     if update.get('status') == 'extraction_complete':
                         results = update.get('results', [])
                         total   = len(results)
+
+                        logo_embs, logo_ok = ml_model.generate_image_embeddings([tm.get('logo_data') for tm in results])
                         
                         for idx, tm in enumerate(results):
-                            emb = None
-                            if tm.get('logo_data'):
-                                emb = ml_model.generate_image_embedding(io.BytesIO(tm['logo_data']))
-                            
                             db.insert_client_trademark({
                                 'file_name':      user_file_name,
                                 'logo_data':      tm.get('logo_data'),
-                                'logo_embedding': emb,
+                                'logo_embedding': logo_embs[idx] if logo_ok[idx] else None,
                                 'applicant_name': tm.get('applicant_name') or user_file_name,
                                 'description':    tm.get('description') or "Extracted from PDF",
                                 'custom_date':    user_date
@@ -410,21 +441,19 @@ def upload_client_dataset():
 def api_get_client_trademarks():
     search_query = request.args.get('q', '').strip()
     
-    conn = db.get_db_connection()
-    cur  = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    
-    if search_query:
-        sql = """
-            SELECT id, applicant_name, description, upload_date 
-            FROM client_trademarks 
-            WHERE applicant_name ILIKE %s OR description ILIKE %s 
-            ORDER BY upload_date DESC
-        """
-        cur.execute(sql, (f'%{search_query}%', f'%{search_query}%'))
-    else:
-        cur.execute("SELECT id, applicant_name, description, upload_date FROM client_trademarks ORDER BY upload_date DESC")
-    
-    rows    = cur.fetchall()
+    with db.db_cursor(dict_cursor=True) as cur:
+        if search_query:
+            sql = """
+                SELECT id, applicant_name, description, upload_date 
+                FROM client_trademarks 
+                WHERE applicant_name ILIKE %s OR description ILIKE %s 
+                ORDER BY upload_date DESC
+            """
+            cur.execute(sql, (f'%{search_query}%', f'%{search_query}%'))
+        else:
+            cur.execute("SELECT id, applicant_name, description, upload_date FROM client_trademarks ORDER BY upload_date DESC")
+        rows = cur.fetchall()
+
     results = []
     for r in rows:
         results.append({
@@ -433,9 +462,6 @@ def api_get_client_trademarks():
             'description':    r['description'],
             'upload_date':    str(r['upload_date']) if r['upload_date'] else "N/A"
         })
-        
-    cur.close()
-    conn.close()
     return jsonify(results)
 
 @app.route('/api/client-trademarks', methods=['DELETE'])
@@ -446,12 +472,7 @@ def api_delete_client_trademarks():
     if not ids:
         return jsonify({'success': False}), 400
     
-    conn = db.get_db_connection()
-    cur  = conn.cursor()
-    cur.execute("DELETE FROM client_trademarks WHERE id = ANY(%s)", (ids,))
-    conn.commit()
-    deleted = cur.rowcount
-    cur.close(); conn.close()
+    deleted = db.delete_client_trademarks(ids)
     return jsonify({'success': True, 'deleted': deleted})
 
 @app.route('/client-logo/<int:client_id>')
@@ -474,21 +495,23 @@ def api_trademarks():
     year         = request.args.get('batch_year')
     q            = request.args.get('q')
     class_filter = request.args.get('class')
-
-    if q or class_filter:
-        rows = db.search_trademarks(words=q, class_filter=class_filter)
-    else:
-        rows = db.get_all_trademarks_manageTab()
-
+    class_match  = request.args.get('class_match', 'any')
+    category     = request.args.get('category')
+    with_total   = request.args.get('total', 'false').lower() in ('1', 'true')
+    try:
+        limit = request_number('limit', 50, int, 1, 500)
+        after = request_number('after', None, int)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    # Filters run in SQL; pages follow id DESC (pass next_after back as `after`)
+    rows, next_after, total = db.get_trademarks_page(limit=limit, after=after, with_total=with_total,
+                                                     words=q, class_filter=class_filter, batch_number=batch,
+                                                     batch_year=year, category=category, class_match=class_match)
     results = []
     for row in rows:
         r = dict(row)
 
-        if batch and str(r.get('batch_number', '')) != str(batch):
-            continue
-        if year and str(r.get('batch_year', '')) != str(year):
-            continue
-
         if r.get('file_name'):
             display_name = r.get('file_name')
         elif r.get('batch_number') and r.get('batch_year'):
@@ -503,6 +526,7 @@ def api_trademarks():
             'trademark_name': r.get('trademark_name'),
             'class_indices':  r.get('class_indices'),
             'applicant_name': r.get('applicant_name'),
+            'agent_details':  r.get('agent_details'),
             'description':    r.get('description'),
             'batch_number':   r.get('batch_number'),
             'batch_year':     r.get('batch_year'),
@@ -511,7 +535,10 @@ def api_trademarks():
             'has_logo':       bool(r.get('has_logo'))
         })
 
-    return jsonify({'success': True, 'trademarks': results})
+    payload = {'success': True, 'trademarks': results, 'next_after': next_after}
+    if with_total:
+        payload['total'] = total
+    return jsonify(payload)
 
 @app.route('/api/trademarks', methods=['DELETE'])
 @admin_required
@@ -532,35 +559,99 @@ def api_delete_trademarks():
 
     return jsonify({'success': True, 'deleted': deleted, 'errors': errors})
 
+# ===============================================================================================
+# ML DIAGNOSTICS
+# ===============================================================================================
+
+@app.route('/api/ready', methods=['GET'])
+def api_ready():
+    status = ml_model.status()
+    ready  = ml_model.is_ready(need_index=True)
+    return jsonify({'ready': ready, **status}), (200 if ready else 503)
+
+@app.route('/api/ml/stats', methods=['GET'])
+@admin_required
+def api_ml_stats():
+    stats = {
+        'embedding_cache': ml_model.cache.stats() if ml_model.cache else None,
+        'micro_batcher':   ml_model.micro_batch_stats(),
+        'target_indexes':  target_indexes.stats(),
+        'db_pool':         db.pool_stats(),
+    }
+    return jsonify({'success': True, 'stats': stats})
+
 # ===============================================================================================
 # SEARCH & TEXT/IMAGE SEARCH
 # ===============================================================================================
 
+def request_number(name, default, cast=float, minimum=None, maximum=None, values=None):
+    """
+    Reads a numeric form/query parameter (or a key of `values`, e.g. a JSON body), clamped to
+    [minimum, maximum]. Raises ValueError if malformed.
+    """
+    raw = (request.values if values is None else values).get(name)
+    if raw is None or str(raw).strip() == '':
+        return default
+    try:
+        value = cast(raw)
+    except (TypeError, ValueError):
+        raise ValueError(f"'{name}' must be a number")
+    if minimum is not None:
+        value = max(minimum, value)
+    if maximum is not None:
+        value = min(maximum, value)
+    return value
+
 @app.route('/search')
 def search():
-    all_trademarks = db.get_all_trademarks() 
-    return render_template('search.html', trademarks=all_trademarks)
+    # Only the first page is rendered; search.js pages through the rest on scroll
+    trademarks, next_after, _ = db.get_trademarks_page(limit=50)
+    return render_template('search.html', trademarks=trademarks, next_after=next_after)
 
 @app.route('/api/text_search', methods=['POST'])
 def api_text_search():
-    if request.is_json:
-        data         = request.get_json()
-        words        = data.get('words', '')
-        class_filter = data.get('class_filter', '')
-    else:
-        words        = request.form.get('words', '')
-        class_filter = request.form.get('class_filter', '')
-
-    words = re.sub(r'\s+', '', words)
+    data         = (request.get_json(silent=True) or {}) if request.is_json else request.form
+    words        = data.get('words', '')
+    class_filter = data.get('class_filter', '')
+    class_match  = data.get('class_match', 'any')
+    mode         = data.get('mode', 'substring')
+
+    if mode != 'fulltext':
+        # mode=fulltext keeps the spaces: they separate the query's terms
+        words = re.sub(r'\s+', '', words)
     print("CLEAN WORDS:", repr(words))
 
-    results = db.search_trademarks(words=words, class_filter=class_filter)
+    # Sending `after` (empty for the first page) asks for keyset paging in the same ranking order:
+    # {'success', 'trademarks', 'next_after'}, like /api/trademarks. Otherwise a plain list.
+    paged = 'after' in data
+    try:
+        # Typeahead callers pass a small limit; best matches come first when words are given
+        limit = request_number('limit', 50 if paged else None, int, 1, max_search_results(), values=data)
+        if paged:
+            results, next_after = db.search_trademarks_page(limit=limit, after=data.get('after') or None,
+                                                            words=words, class_filter=class_filter,
+                                                            mode=mode, class_match=class_match)
+        else:
+            results = db.search_trademarks(words=words, class_filter=class_filter, limit=limit, mode=mode,
+                                           class_match=class_match)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if paged:
+        return jsonify({'success': True, 'trademarks': [dict(row) for row in results], 'next_after': next_after})
     return jsonify([dict(row) for row in results])
 
 @app.route('/api/image_search', methods=['POST'])
+@ml_required(need_index=True)
 def api_image_search():
     words        = request.form.get('words')
     class_filter = request.form.get('class_filter')
+    category     = request.form.get('category')
+    batch_number = request.form.get('batch_number')
+    batch_year   = request.form.get('batch_year')
+    components   = request.form.get('components', 'false').lower() == 'true' and ml_model.use_components
+    aggregate    = request.form.get('aggregate', 'max')
+    class_match  = request.form.get('class_match', 'any')
     image_file   = request.files.get('image')
 
     if not image_file:
@@ -570,23 +661,90 @@ def api_image_search():
     if query_embedding is None:
         return jsonify({'error': 'AI failed to process image'}), 400
 
-    distances, similar_ids = ml_model.search_logo_index(query_embedding, return_distances=True)
-
-    if not similar_ids:
-        return jsonify([])
-
-    match_ids = [similar_ids[i] for i, d in enumerate(distances) if d <= 0.10]
-    if not match_ids:
-        return jsonify([])
+    try:
+        # threshold is a cosine similarity: 0.90 matches the old "distance <= 0.10" cut
+        threshold = request_number('threshold', 0.90, float, -1.0, 1.0)
+        limit     = request_number('limit', 50, int, 1, max_search_results())
+        offset    = request_number('offset', 0, int, 0)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Class / category / batch filters run inside FAISS (a mark in ANY of the classes); `words`
+    # and class_match=all (a mark in EVERY class, int[] @> in SQL) are applied to the hits in SQL
+    filters = dict(category=category, classes=class_filter, batch_number=batch_number, batch_year=batch_year)
+    all_classes = class_match == 'all' and class_filter and class_filter.strip()
+    if (words and words.strip()) or components or all_classes:
+        # The SQL filters and component merging reorder / drop hits, so work on the
+        # complete ranked set before paging
+        hits    = ml_model.range_search_logo_index(query_embedding, threshold, **filters)
+        ranked  = list(zip(hits['ids'], hits['similarities']))
+        if components:
+            # A mark whose device (or wordmark) alone matches the query scores by that component
+            best = dict(ranked)
+            comp_scores, comp_ids = ml_model.search_logo_components(query_embedding, k=max_search_results(),
+                                                                    threshold=threshold, aggregate=aggregate, **filters)
+            for rid, score in zip(comp_ids, comp_scores):
+                best[rid] = max(best.get(rid, -1.0), score)
+            ranked = sorted(best.items(), key=lambda kv: kv[1], reverse=True)
+        # No hits: skip SQL entirely (an empty id_list would mean "no id filter", i.e. the whole table)
+        rows    = {row['id']: dict(row) for row in db.search_trademarks(words=words, id_list=[rid for rid, _ in ranked],
+                                                                        class_filter=class_filter if all_classes else None,
+                                                                        class_match='all')} if ranked else {}
+        ranked  = [(rid, sim) for rid, sim in ranked if rid in rows]
+        total   = len(ranked)
+        ranked  = ranked[offset:offset + limit]
+    else:
+        hits    = ml_model.range_search_logo_index(query_embedding, threshold, limit, offset, **filters)
+        ranked  = list(zip(hits['ids'], hits['similarities']))
+        rows    = {row['id']: dict(row) for row in db.search_trademarks(id_list=hits['ids'])} if ranked else {}
+        total   = hits['total']
 
-    results        = db.search_trademarks(words=words, class_filter=class_filter, id_list=match_ids)
-    results_dict   = {row['id']: dict(row) for row in results}
     sorted_results = []
-    for rid in match_ids:
-        if rid in results_dict:
-            sorted_results.append(results_dict[rid])
+    for rid, sim in ranked:
+        if rid in rows:
+            rows[rid]['similarity'] = round(sim, 4)
+            sorted_results.append(rows[rid])
+
+    response = jsonify(sorted_results)
+    # The body stays a plain list for search.js; paging info travels in headers
+    response.headers['X-Total-Count']      = str(total)
+    response.headers['X-Result-Truncated'] = 'true' if hits['truncated'] else 'false'
+    if offset + limit < total:
+        response.headers['X-Next-Offset'] = str(offset + limit)
+    return response
+
+@app.route('/api/semantic_search', methods=['GET', 'POST'])
+@ml_required(need_index=True)
+def api_semantic_search():
+    """Meaning-based search over names + goods/services using the stored text embeddings."""
+    data         = request.get_json(silent=True) or request.values
+    if not hasattr(data, 'get'):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    query        = (data.get('query') or data.get('words') or '').strip()
+    class_filter = data.get('class_filter')
+    category     = data.get('category')
+    if not query:
+        return jsonify({'error': 'No query provided'}), 400
+    try:
+        # Same source as the other fields, so a JSON body's limit / threshold are honoured
+        limit     = request_number('limit', 20, int, 1, max_search_results(), values=data)
+        threshold = request_number('threshold', None, float, -1.0, 1.0, values=data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    similarities, ids = ml_model.search_text_index(query, k=limit, threshold=threshold,
+                                                   category=category, classes=class_filter)
+    if not ids:
+        return jsonify([])
 
-    return jsonify(sorted_results)
+    # One round-trip hydrates every hit; rows are re-ordered by similarity afterwards
+    rows    = {row['id']: dict(row) for row in db.search_trademarks(id_list=ids)}
+    results = []
+    for rid, sim in zip(ids, similarities):
+        if rid in rows:
+            rows[rid]['similarity'] = round(sim, 4)
+            results.append(rows[rid])
+    return jsonify(results)
 
 @app.route('/compare')
 def compare():
@@ -725,14 +883,23 @@ def jaccard_tokens(a: str, b: str) -> float:
 # ===============================================================================================
 
 @app.route('/api/perform_comparison', methods=['POST'])
+@ml_required()
 def perform_comparison():
     file            = request.files.get('file')
     source_category = request.form.get('source_category', 'UPLOAD').upper()
     target          = request.form.get('target', 'MYIPO').upper()
     words_field     = request.form.get('words', '').strip()
+    class_filter    = request.form.get('class_filter', '').strip()
+    class_match     = request.form.get('class_match', 'any')
+    try:
+        # Candidates are targets above `threshold` (the scoring below ignores AI scores < 0.3),
+        # at most `limit` per query item and modality; raise limit for complete clearance sets
+        threshold = request_number('threshold', 0.30, float, -1.0, 1.0)
+        limit     = request_number('limit', 20, int, 1, max_search_results())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
     if target == 'CLIENT':
-        db_data       = db.get_all_client_embeddings()
         table_name    = "client_trademarks"
         query_columns = """
             id,
@@ -745,25 +912,18 @@ def perform_comparison():
             logo_data
         """
     else:
-        db_data       = db.get_all_embeddings(category=target)
         table_name    = "trademarks"
         query_columns = """
             id, trademark_name, serial_number, applicant_name, description,
             class_indices, agent_details, logo_data
         """
 
-    if not db_data or not db_data['ids']:
+    indexes = target_indexes.get(target)
+    if not indexes.size:
         return jsonify({'error': f'Target {target} database is empty'}), 400
-
-    db_logo_vectors = np.vstack(db_data['logo']).astype('float32')
-    db_text_vectors = np.vstack(db_data['text']).astype('float32')
-    faiss.normalize_L2(db_logo_vectors)
-    faiss.normalize_L2(db_text_vectors)
-
-    image_index = faiss.IndexFlatIP(512)
-    text_index  = faiss.IndexFlatIP(384)
-    image_index.add(db_logo_vectors)
-    text_index.add(db_text_vectors)
+    # Both indexes map straight to DB ids, so search results need no id lookup
+    image_index = indexes.logo_index
+    text_index  = indexes.text_index
 
     query_items = []
     if source_category == 'UPLOAD':
@@ -811,37 +971,38 @@ def perform_comparison():
             except:
                 pass
 
-    text_embeddings = ml_model.text_model.encode(all_texts, batch_size=32, convert_to_numpy=True)
-    faiss.normalize_L2(text_embeddings)
-    D_text, I_text = text_index.search(text_embeddings.astype('float32'), 10)
+    # A class filter (exact int[] match in SQL, trademark targets only) drops candidates after the
+    # vector search, so fetch up to the global cap and trim to `limit` once filtered
+    class_sql, class_params = ("", [])
+    if class_filter and table_name == "trademarks":
+        class_sql, class_params = db.class_filter_sql(class_filter, class_match)
+    candidates = max_search_results() if class_sql else limit
+
+    text_embeddings, _ = ml_model.generate_text_embeddings(all_texts)
+    text_results = range_search(text_index, text_embeddings, threshold, candidates)
 
     logo_results = {}
     if all_logo_images:
-        logo_embeddings = ml_model.image_model.encode(all_logo_images, batch_size=32, convert_to_numpy=True)
-        faiss.normalize_L2(logo_embeddings)
-        D_logo, I_logo = image_index.search(logo_embeddings.astype('float32'), 20)
-        for i, query_idx in enumerate(logo_mapping):
-            logo_results[query_idx] = (D_logo[i], I_logo[i])
+        logo_embeddings, _ = ml_model.generate_image_embeddings(all_logo_images)
+        for query_idx, hits in zip(logo_mapping, range_search(image_index, logo_embeddings, threshold, candidates)):
+            logo_results[query_idx] = hits
 
     final_results = []
-    conn = db.get_db_connection()
-    cur  = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-
     all_potential_ids = set()
     for i, _ in enumerate(query_items):
-        for idx in I_text[i]:
-            if idx != -1: all_potential_ids.add(db_data['ids'][idx])
+        all_potential_ids.update(int(idx) for idx in text_results[i][1])
         if i in logo_results:
-            for idx in logo_results[i][1]:
-                if idx != -1: all_potential_ids.add(db_data['ids'][idx])
+            all_potential_ids.update(int(idx) for idx in logo_results[i][1])
 
     master_db_lookup = {}
     if all_potential_ids:
-        cur.execute(
-            f"SELECT {query_columns} FROM {table_name} WHERE id = ANY(%s)",
-            (list(all_potential_ids),)
-        )
-        master_db_lookup = {row['id']: row for row in cur.fetchall()}
+        # Only the lookup holds a pooled connection, not the scoring loop below
+        with db.db_cursor(dict_cursor=True) as cur:
+            cur.execute(
+                f"SELECT {query_columns} FROM {table_name} WHERE id = ANY(%s)" + (f" AND {class_sql}" if class_sql else ""),
+                (list(all_potential_ids), *class_params)
+            )
+            master_db_lookup = {row['id']: row for row in cur.fetchall()}
 
     for i, q in enumerate(query_items):
         match_list = []
@@ -861,16 +1022,10 @@ def perform_comparison():
             if img is not None and np.std(img) > 5:
                 q_has_img = True
 
-        t_sim_map = {
-            db_data['ids'][idx]: float(D_text[i][rank])
-            for rank, idx in enumerate(I_text[i]) if idx != -1
-        }
+        t_sim_map = {int(idx): float(sim) for sim, idx in zip(*text_results[i])}
         l_sim_map = {}
         if i in logo_results:
-            l_sim_map = {
-                db_data['ids'][idx]: float(logo_results[i][0][rank])
-                for rank, idx in enumerate(logo_results[i][1]) if idx != -1
-            }
+            l_sim_map = {int(idx): float(sim) for sim, idx in zip(*logo_results[i])}
 
         candidate_ids = set(t_sim_map.keys()) | set(l_sim_map.keys())
 
@@ -939,11 +1094,9 @@ def perform_comparison():
             final_results.append({
                 'query_serial': q.get('serial_number') or q_name_raw or f"Item {i+1}",
                 'matches':      match_list[:3],   # top 3 for UI display
-                'all_matches':  match_list[:20]   # up to {n} for PDF
+                'all_matches':  match_list[:limit]   # up to `limit` for PDF
             })
 
-    cur.close()
-    conn.close()
     return jsonify(final_results)
 
 # ===============================================================================================
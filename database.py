@@ -1,9 +1,20 @@
 import os
 import re
+import json
+import html
+import select
+import socket
+import struct
+import threading
+import time
+from contextlib import contextmanager
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 import numpy as np
 from dotenv import load_dotenv
+from embedding_format import encode_embedding, decode_into
+from index_metadata import nice_classes
 
 # Get .env
 load_dotenv()
@@ -14,72 +25,422 @@ DB_NAME = os.getenv("DB_NAME")
 DB_USER = os.getenv("DB_USER")
 DB_PASS = os.getenv("DB_PASS")
 
+# --- CONNECTION POOL ---
+# get_db_connection() hands out pooled connections; conn.close() returns them to the pool.
+DB_POOL_MIN         = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX         = int(os.getenv("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT     = float(os.getenv("DB_POOL_TIMEOUT", 30))      # seconds to wait for a free connection
+DB_POOL_CHECK_AFTER = float(os.getenv("DB_POOL_CHECK_AFTER", 30))  # idle seconds before a SELECT 1 health check
+
+def _connect():
+    """A new, unpooled connection (the pool's factory; also used by the LISTEN thread)."""
+    return psycopg2.connect(host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASS)
+
+class PoolTimeout(psycopg2.OperationalError):
+    pass
+
+class ConnectionPool:
+    """
+    Blocking wrapper around psycopg2's ThreadedConnectionPool: callers wait (up to DB_POOL_TIMEOUT)
+    instead of getting PoolError when every connection is busy, idle connections are health-checked
+    before reuse, and wait times are recorded.
+    """
+    def __init__(self, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT,
+                 check_after=DB_POOL_CHECK_AFTER):
+        self.maxconn = max(1, maxconn)
+        self.timeout = timeout
+        self.check_after = check_after
+        self._pool = psycopg2.pool.ThreadedConnectionPool(min(minconn, self.maxconn), self.maxconn,
+                                                          host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASS)
+        self._slots = threading.BoundedSemaphore(self.maxconn)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self.counters = {'acquired': 0, 'timeouts': 0, 'wait_ms_total': 0.0, 'wait_ms_max': 0.0,
+                         'health_check_failures': 0, 'discarded': 0, 'in_use': 0}
+
+    def acquire(self):
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.counters['timeouts'] += 1
+            raise PoolTimeout(f"No database connection free after {self.timeout:g}s (DB_POOL_MAX={self.maxconn})")
+        waited = (time.perf_counter() - start) * 1000.0
+        try:
+            conn = self._healthy_connection()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.counters['acquired'] += 1
+            self.counters['in_use'] += 1
+            self.counters['wait_ms_total'] += waited
+            self.counters['wait_ms_max'] = max(self.counters['wait_ms_max'], waited)
+        return conn
+
+    def _healthy_connection(self):
+        for _ in range(self.maxconn + 1):
+            conn = self._pool.getconn()
+            idle = time.monotonic() - self._last_used.get(id(conn), time.monotonic())
+            if not conn.closed and idle < self.check_after:
+                return conn
+            if not conn.closed:
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT 1")
+                    conn.rollback()
+                    return conn
+                except psycopg2.Error:
+                    pass
+            # Server restarted, idle timeout, network blip... replace the connection
+            with self._lock:
+                self.counters['health_check_failures'] += 1
+            self._discard(conn)
+        raise psycopg2.OperationalError("Could not get a healthy database connection")
+
+    def _discard(self, conn):
+        self._last_used.pop(id(conn), None)
+        with self._lock:
+            self.counters['discarded'] += 1
+        self._pool.putconn(conn, close=True)
+
+    def release(self, conn):
+        try:
+            if conn.closed:
+                self._discard(conn)
+                return
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()   # never hand the next caller someone else's open transaction
+            self._last_used[id(conn)] = time.monotonic()
+            self._pool.putconn(conn)
+        except psycopg2.Error:
+            self._discard(conn)
+        finally:
+            with self._lock:
+                self.counters['in_use'] -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            s = dict(self.counters)
+        s['wait_ms_avg'] = round(s['wait_ms_total'] / s['acquired'], 3) if s['acquired'] else 0.0
+        s['wait_ms_total'] = round(s['wait_ms_total'], 3)
+        s['wait_ms_max'] = round(s['wait_ms_max'], 3)
+        s['max'] = self.maxconn
+        return s
+
+class PooledConnection:
+    """
+    A pooled psycopg2 connection. close() returns it to the pool (rolling back anything left
+    open); as a context manager it commits on success, rolls back on error, then returns it.
+    """
+    __slots__ = ('_conn', '_pool')
+
+    def __init__(self, conn, pool):
+        self._conn = conn
+        self._pool = pool
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise psycopg2.InterfaceError("connection already returned to the pool")
+        return getattr(self._conn, name)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool.release(conn)
+
+    def __del__(self):
+        # A caller that raised before close() must not leak its pool slot
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self._conn is not None and not self._conn.closed:
+                if exc_type is None:
+                    self._conn.commit()
+                else:
+                    self._conn.rollback()
+        finally:
+            self.close()
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """The process-wide pool, created on first use (and again in each forked worker)."""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool, _pool_pid = ConnectionPool(), os.getpid()
+    return _pool
+
 def get_db_connection():
-    """Establishes a connection to the PostgreSQL database."""
-    conn = psycopg2.connect(host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASS)
-    return conn
+    """Borrows a connection from the pool; conn.close() gives it back."""
+    pool = get_pool()
+    return PooledConnection(pool.acquire(), pool)
+
+@contextmanager
+def db_cursor(dict_cursor=False):
+    """with db_cursor() as cur: ... -- commits on success, rolls back on error, returns the connection."""
+    with get_db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor if dict_cursor else None)
+        try:
+            yield cur
+        finally:
+            cur.close()
+
+def pool_stats():
+    return get_pool().stats() if _pool is not None else {}
+
+# --- WRITE LISTENERS ---
+# Callbacks run after a trademark write commits, e.g. to keep FAISS indexes in step.
+# Signature: fn(table, upserted=[ids], deleted=[ids], category=None, vectors=None, metadata=None)
+# where vectors = {'logo': {id: vec}, 'text': {id: vec}} and metadata = {id: {category, class_indices,
+# batch_number, batch_year}} for the upserted rows. vectors / metadata are None when the write was
+# made by another worker (see CROSS-WORKER CHANGE EVENTS): listeners load the rows themselves.
+_write_listeners = []
+
+def register_write_listener(fn):
+    if fn not in _write_listeners:
+        _write_listeners.append(fn)
+
+def _notify_write(table, upserted=None, deleted=None, category=None, vectors=None, metadata=None):
+    for fn in list(_write_listeners):
+        try:
+            fn(table, upserted=upserted or [], deleted=deleted or [], category=category,
+               vectors=vectors, metadata=metadata)
+        except Exception as e:
+            print(f"Write listener failed for {table}: {e}")
+
+# --- CROSS-WORKER CHANGE EVENTS ---
+# Every trademark write also sends a NOTIFY (delivered on commit) with the ids it touched, so other
+# app processes can patch their own indexes. Payloads are capped at 8000 bytes by Postgres.
+CHANGE_CHANNEL = 'marklogic_changes'
+_NOTIFY_IDS_PER_EVENT = 500
+
+def _origin():
+    # Computed per call: a preforking server imports this module before forking its workers
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def _emit_change(cur, table, upserted=(), deleted=(), category=None):
+    """Queues NOTIFY events for a write inside the caller's transaction."""
+    upserted, deleted = list(upserted), list(deleted)
+    for start in range(0, max(len(upserted), len(deleted)), _NOTIFY_IDS_PER_EVENT):
+        payload = json.dumps({
+            'origin':   _origin(),
+            'table':    table,
+            'upserted': upserted[start:start + _NOTIFY_IDS_PER_EVENT],
+            'deleted':  deleted[start:start + _NOTIFY_IDS_PER_EVENT],
+            'category': category,
+        })
+        cur.execute("SELECT pg_notify(%s, %s)", (CHANGE_CHANNEL, payload))
+
+def listen_for_changes(stop_event=None, on_resync=None, timeout=5.0):
+    """
+    Blocks on LISTEN and replays other workers' writes through the write listeners (without
+    vectors). After a dropped connection on_resync() runs, since events sent meanwhile are lost.
+    """
+    stop_event = stop_event or threading.Event()
+    backoff = 1.0
+    connected_before = False
+    while not stop_event.is_set():
+        conn = None
+        try:
+            conn = _connect()   # LISTEN needs its own long-lived connection, never a pooled one
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cur = conn.cursor()
+            cur.execute(f"LISTEN {CHANGE_CHANNEL}")
+            if connected_before and on_resync:
+                on_resync()
+            connected_before, backoff = True, 1.0
+            while not stop_event.is_set():
+                if select.select([conn], [], [], timeout) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    _dispatch_change(conn.notifies.pop(0).payload)
+        except Exception as e:
+            print(f"Change listener connection lost: {e}; retrying in {backoff:.0f}s")
+            stop_event.wait(backoff)
+            backoff = min(backoff * 2, 60.0)
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+def _dispatch_change(payload):
+    try:
+        event = json.loads(payload)
+    except ValueError:
+        print(f"Ignoring malformed change event: {payload[:100]}")
+        return
+    if event.get('origin') == _origin():
+        return   # our own write, listeners already ran in-process
+    _notify_write(event.get('table'), upserted=event.get('upserted'), deleted=event.get('deleted'),
+                  category=event.get('category'))
+
+def start_change_listener(on_resync=None):
+    """Runs listen_for_changes in a daemon thread; returns (thread, stop_event)."""
+    stop_event = threading.Event()
+    thread = threading.Thread(target=listen_for_changes, args=(stop_event, on_resync),
+                              daemon=True, name="db-change-listener")
+    thread.start()
+    return thread, stop_event
 
 def init_db():
     """
     Initializes the database, creating the 'trademarks' and 'users' tables.
     Includes law-firm specific columns.
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Create the trademarks table with NEW columns for the Perfect Extractor
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS trademarks (
-            id SERIAL PRIMARY KEY,
-            serial_number VARCHAR(50) UNIQUE NOT NULL,
-            int_reg_number VARCHAR(50),
-            class_indices TEXT,
-            registration_date TEXT,
-            trademark_name TEXT,
-            description TEXT,
-            disclaimer TEXT,
-            applicant_name TEXT,
-            applicant_address TEXT,
-            agent_details TEXT,
-            logo_data BYTEA,
-            evidence_snapshot BYTEA,
-            text_embedding BYTEA,
-            logo_embedding BYTEA,
-            batch_number VARCHAR(10),
-            batch_year VARCHAR(10),
-            category VARCHAR(50) DEFAULT 'MYIPO',
-            is_split BOOLEAN DEFAULT FALSE,
-            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-        );
-    """)
+    with db_cursor() as cur:
+        # Create the trademarks table with NEW columns for the Perfect Extractor
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS trademarks (
+                id SERIAL PRIMARY KEY,
+                serial_number VARCHAR(50) UNIQUE NOT NULL,
+                int_reg_number VARCHAR(50),
+                class_indices TEXT,
+                registration_date TEXT,
+                trademark_name TEXT,
+                description TEXT,
+                disclaimer TEXT,
+                applicant_name TEXT,
+                applicant_address TEXT,
+                agent_details TEXT,
+                logo_data BYTEA,
+                evidence_snapshot BYTEA,
+                text_embedding BYTEA,
+                logo_embedding BYTEA,
+                batch_number VARCHAR(10),
+                batch_year VARCHAR(10),
+                category VARCHAR(50) DEFAULT 'MYIPO',
+                is_split BOOLEAN DEFAULT FALSE,
+                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
 
-    # Create the users table
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id SERIAL PRIMARY KEY,
-            username VARCHAR(80) UNIQUE NOT NULL,
-            email VARCHAR(120) UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            role VARCHAR(20) NOT NULL,
-            is_temporary_password BOOLEAN DEFAULT TRUE,
-            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-        );
-    """)
+        # Create the users table
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id SERIAL PRIMARY KEY,
+                username VARCHAR(80) UNIQUE NOT NULL,
+                email VARCHAR(120) UNIQUE NOT NULL,
+                password_hash TEXT NOT NULL,
+                role VARCHAR(20) NOT NULL,
+                is_temporary_password BOOLEAN DEFAULT TRUE,
+                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
 
-    # Client Trademarks Table
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS client_trademarks (
-            id SERIAL PRIMARY KEY,
-            file_name TEXT,
-            logo_data BYTEA,
-            logo_embedding BYTEA,
-            applicant_name TEXT,
-            description TEXT,
-            upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-    """)
-    conn.commit()
-    cur.close(); conn.close()
+        # Client Trademarks Table
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS client_trademarks (
+                id SERIAL PRIMARY KEY,
+                file_name TEXT,
+                logo_data BYTEA,
+                logo_embedding BYTEA,
+                applicant_name TEXT,
+                description TEXT,
+                upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+
+        # Per-component logo embeddings for composite-mark matching (optional, LOGO_COMPONENTS=True)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS logo_components (
+                trademark_id INTEGER NOT NULL REFERENCES trademarks(id) ON DELETE CASCADE,
+                component_no SMALLINT NOT NULL,
+                bbox INTEGER[],
+                area INTEGER,
+                ink_ratio REAL,
+                embedding BYTEA NOT NULL,
+                PRIMARY KEY (trademark_id, component_no)
+            );
+        """)
+
+        # Change counters used to tag persisted FAISS indexes with a dataset version
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS dataset_version (
+                table_name TEXT PRIMARY KEY,
+                change_counter BIGINT NOT NULL DEFAULT 0
+            );
+        """)
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION bump_dataset_version() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO dataset_version (table_name, change_counter) VALUES (TG_TABLE_NAME, 1)
+                ON CONFLICT (table_name) DO UPDATE SET change_counter = dataset_version.change_counter + 1;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        """)
+        for table in ('trademarks', 'client_trademarks', 'logo_components'):
+            cur.execute(f"DROP TRIGGER IF EXISTS {table}_dataset_version ON {table};")
+            cur.execute(f"""
+                CREATE TRIGGER {table}_dataset_version
+                AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+                FOR EACH STATEMENT EXECUTE FUNCTION bump_dataset_version();
+            """)
+
+        # Persistent tier of the content-hash embedding cache (see embedding_cache.py)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS embedding_cache (
+                cache_key BYTEA PRIMARY KEY,
+                model_name TEXT NOT NULL,
+                embedding BYTEA NOT NULL,
+                last_used TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_embedding_cache_last_used ON embedding_cache (last_used);")
+
+        # Keyset pages (ORDER BY id DESC) filtered by batch / category walk these instead of the table
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_trademarks_batch ON trademarks (batch_year, batch_number, id DESC);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_trademarks_category ON trademarks (category, id DESC);")
+
+        # Text search: trigram GIN indexes serve ILIKE '%term%' and similarity() ranking, and the
+        # whitespace-free lower-case serial replaces a per-row REGEXP_REPLACE in every search
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+        cur.execute(r"""
+            ALTER TABLE trademarks ADD COLUMN IF NOT EXISTS serial_normalized TEXT
+            GENERATED ALWAYS AS (lower(regexp_replace(serial_number, '\s+', '', 'g'))) STORED;
+        """)
+        for column in ('trademark_name', 'applicant_name', 'description', 'serial_normalized'):
+            cur.execute(f"CREATE INDEX IF NOT EXISTS idx_trademarks_{column}_trgm ON trademarks USING GIN ({column} gin_trgm_ops);")
+
+        # Full-text search over name (A), applicant (B) and goods / services (C), for ranked results
+        cur.execute("""
+            ALTER TABLE trademarks ADD COLUMN IF NOT EXISTS search_vector tsvector
+            GENERATED ALWAYS AS (
+                setweight(to_tsvector('english', COALESCE(trademark_name, '')), 'A') ||
+                setweight(to_tsvector('english', COALESCE(applicant_name, '')), 'B') ||
+                setweight(to_tsvector('english', COALESCE(description, '')), 'C')
+            ) STORED;
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_trademarks_search_vector ON trademarks USING GIN (search_vector);")
+
+        # Nice classes as int[] (written on insert, backfilled here) for exact, GIN-backed && / @> filters
+        cur.execute("ALTER TABLE trademarks ADD COLUMN IF NOT EXISTS class_numbers INTEGER[];")
+        # Only when rows need it: the statement trigger above bumps dataset_version even for an UPDATE
+        # of zero rows, which would invalidate every persisted FAISS index on each start
+        cur.execute("SELECT EXISTS (SELECT 1 FROM trademarks WHERE class_numbers IS NULL AND class_indices IS NOT NULL);")
+        if cur.fetchone()[0]:
+            cur.execute(r"""
+                UPDATE trademarks
+                SET class_numbers = ARRAY(
+                    SELECT DISTINCT ltrim(m[1], '0')::int FROM regexp_matches(class_indices, '(\d+)', 'g') AS m
+                    WHERE length(ltrim(m[1], '0')) BETWEEN 1 AND 2   -- same as nice_classes(): 1..99
+                    ORDER BY 1
+                )
+                WHERE class_numbers IS NULL AND class_indices IS NOT NULL;
+            """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_trademarks_class_numbers ON trademarks USING GIN (class_numbers);")
     
     print("Database initialized successfully.")
 
@@ -89,20 +450,16 @@ def init_db():
 
 def get_user_by_email(email):
     """Fetches a user record by their email address."""
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cur.execute("SELECT * FROM users WHERE email = %s", (email,))
-    user = cur.fetchone()
-    cur.close(); conn.close()
+    with db_cursor(dict_cursor=True) as cur:
+        cur.execute("SELECT * FROM users WHERE email = %s", (email,))
+        user = cur.fetchone()
     return user
 
 def get_all_users():
     """Fetches all users from the database."""
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cur.execute("SELECT id, username, email, role FROM users ORDER BY id ASC")
-    users = cur.fetchall()
-    cur.close(); conn.close()
+    with db_cursor(dict_cursor=True) as cur:
+        cur.execute("SELECT id, username, email, role FROM users ORDER BY id ASC")
+        users = cur.fetchall()
     return users
 
 def delete_user_by_id(user_id):
@@ -162,19 +519,13 @@ def add_user(username, email, password_hash):
 
 def admin_reset_password(user_id, new_password_hash):
     """Resets a user's password and forces change on next login."""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET password_hash = %s, is_temporary_password = TRUE WHERE id = %s", (new_password_hash, user_id))
-    conn.commit()
-    cur.close(); conn.close()
+    with db_cursor() as cur:
+        cur.execute("UPDATE users SET password_hash = %s, is_temporary_password = TRUE WHERE id = %s", (new_password_hash, user_id))
 
 def update_password_and_deactivate_temp_flag(user_id, new_password_hash):
     """Updates a user's password and sets the temporary flag to FALSE."""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET password_hash = %s, is_temporary_password = FALSE WHERE id = %s", (new_password_hash, user_id))
-    conn.commit()
-    cur.close(); conn.close()
+    with db_cursor() as cur:
+        cur.execute("UPDATE users SET password_hash = %s, is_temporary_password = FALSE WHERE id = %s", (new_password_hash, user_id))
 
 # ==============================================================================
 # TRADEMARK MANAGEMENT FUNCTIONS (EXPANDED FOR PERFECT EXTRACTOR)
@@ -183,12 +534,13 @@ def update_password_and_deactivate_temp_flag(user_id, new_password_hash):
 def insert_client_trademark(data):
     conn = get_db_connection()
     cur = conn.cursor()
-    logo_emb = data['logo_embedding'].tobytes() if data.get('logo_embedding') is not None else None
+    logo_emb = encode_embedding(data['logo_embedding']) if data.get('logo_embedding') is not None else None
     try:
         cur.execute("""
             INSERT INTO client_trademarks 
             (file_name, logo_data, logo_embedding, applicant_name, description, upload_date)
             VALUES (%s, %s, %s, %s, %s, %s)
+            RETURNING id
         """, (
             data.get('file_name'),
             psycopg2.Binary(data.get('logo_data')) if data.get('logo_data') else None,
@@ -197,6 +549,8 @@ def insert_client_trademark(data):
             data.get('description'),
             data.get('custom_date') # This maps to the date the user selected
         ))
+        new_id = cur.fetchone()[0]
+        _emit_change(cur, 'client_trademarks', upserted=[new_id], category='CLIENT')
         conn.commit()
     except Exception as e:
         conn.rollback()
@@ -204,172 +558,402 @@ def insert_client_trademark(data):
     finally:
         cur.close(); conn.close()
 
+    vectors = {'logo': {new_id: data['logo_embedding']}} if data.get('logo_embedding') is not None else None
+    _notify_write('client_trademarks', upserted=[new_id], category='CLIENT', vectors=vectors)
+    return new_id
+
+def delete_client_trademarks(ids):
+    """Deletes client trademarks by id; returns the number of rows removed."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("DELETE FROM client_trademarks WHERE id = ANY(%s) RETURNING id", (list(ids),))
+        deleted = [r[0] for r in cur.fetchall()]
+        if deleted:
+            _emit_change(cur, 'client_trademarks', deleted=deleted, category='CLIENT')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close(); conn.close()
+    if deleted:
+        _notify_write('client_trademarks', deleted=deleted, category='CLIENT')
+    return len(deleted)
+
 def get_client_query_items():
     """Fetches items from the client table to be used as search queries."""
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    # Note: We use applicant_name as trademark_name for consistency in the search loop
-    cur.execute("""
-        SELECT id, applicant_name as trademark_name, description, logo_data 
-        FROM client_trademarks
-    """)
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
+    with db_cursor(dict_cursor=True) as cur:
+        # Note: We use applicant_name as trademark_name for consistency in the search loop
+        cur.execute("""
+            SELECT id, applicant_name as trademark_name, description, logo_data 
+            FROM client_trademarks
+        """)
+        rows = cur.fetchall()
     return [dict(r) for r in rows]
 
 def get_client_logo(client_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT logo_data FROM client_trademarks WHERE id = %s", (client_id,))
-    row = cur.fetchone()
-    cur.close(); conn.close()
+    with db_cursor() as cur:
+        cur.execute("SELECT logo_data FROM client_trademarks WHERE id = %s", (client_id,))
+        row = cur.fetchone()
     return row[0] if row else None
 
 def get_all_client_embeddings():
-    """Fetches embeddings specifically from the client table for FAISS."""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, logo_embedding FROM client_trademarks WHERE logo_embedding IS NOT NULL")
-    rows = cur.fetchall()
-    cur.close(); conn.close()
+    """Fetches embeddings specifically from the client table for FAISS (same shape as get_all_embeddings)."""
+    # Client records carry no text embeddings: the text column stays empty and invalid
+    return _embedding_columns("""
+        SELECT id, NULL::bytea, logo_embedding FROM client_trademarks
+        WHERE logo_embedding IS NOT NULL ORDER BY id
+    """)
 
-    db_data = {'logo': [], 'ids': [], 'text': []} # Text is empty for client usually
-    for row in rows:
-        db_id, logo_bytes = row
-        db_data['ids'].append(db_id)
-        db_data['logo'].append(np.frombuffer(logo_bytes, dtype=np.float32))
-        # Provide dummy text embedding to keep FAISS index logic consistent
-        db_data['text'].append(np.zeros(384, dtype=np.float32)) 
-    return db_data
+_TRADEMARK_COLUMNS = (
+    'serial_number', 'int_reg_number', 'class_indices', 'registration_date',
+    'trademark_name', 'description', 'disclaimer', 'applicant_name',
+    'applicant_address', 'agent_details', 'logo_data', 'evidence_snapshot',
+    'text_embedding', 'logo_embedding', 'category', 'is_split',
+    'batch_number', 'batch_year', 'class_numbers'
+)
 
-def insert_trademark(data):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
+# xmax = 0 only for rows this statement inserted (an updated row carries the updating xid)
+_TRADEMARK_UPSERT = f"""
+    INSERT INTO trademarks ({', '.join(_TRADEMARK_COLUMNS)})
+    VALUES %s
+    ON CONFLICT (serial_number) DO UPDATE SET
+        trademark_name = EXCLUDED.trademark_name,
+        class_indices = EXCLUDED.class_indices,
+        class_numbers = EXCLUDED.class_numbers,
+        description = EXCLUDED.description,
+        applicant_name = EXCLUDED.applicant_name,
+        applicant_address = EXCLUDED.applicant_address,
+        agent_details = EXCLUDED.agent_details,
+        logo_data = EXCLUDED.logo_data,
+        evidence_snapshot = EXCLUDED.evidence_snapshot,
+        text_embedding = EXCLUDED.text_embedding,
+        logo_embedding = EXCLUDED.logo_embedding,
+        batch_number = EXCLUDED.batch_number,
+        batch_year = EXCLUDED.batch_year
+    RETURNING id, serial_number, (xmax = 0) AS inserted
+"""
+
+def _clean_description(data):
     # This removes "All included in Class 11" so you get pure goods data
     raw_desc = data.get('description', '')
     if raw_desc:
         data['description'] = re.sub(r'All included in Class \d+\.?', '', raw_desc, flags=re.I).strip()
 
-    text_emb = data['text_embedding'].tobytes() if data.get('text_embedding') is not None else None
-    logo_emb = data['logo_embedding'].tobytes() if data.get('logo_embedding') is not None else None
+def _trademark_row(data):
+    text_emb = encode_embedding(data['text_embedding']) if data.get('text_embedding') is not None else None
+    logo_emb = encode_embedding(data['logo_embedding']) if data.get('logo_embedding') is not None else None
+    return (
+        data.get('serial_number'), data.get('int_reg_number'),
+        data.get('class_indices'), data.get('registration_date'),
+        data.get('trademark_name'), data.get('description'),
+        data.get('disclaimer'), data.get('applicant_name'),
+        data.get('applicant_address'), data.get('agent_details'),
+        data.get('logo_data'), data.get('evidence_snapshot'),
+        text_emb, logo_emb, data.get('category', 'MYIPO'),
+        data.get('is_split', False),
+        data.get('batch_number'),
+        data.get('batch_year'),
+        nice_classes(data.get('class_numbers') if data.get('class_numbers') is not None else data.get('class_indices'))
+    )
+
+def insert_trademark(data):
+    """Upserts one trademark by serial number; returns its id, or None if the write failed."""
+    return _upsert_trademarks([data], retry_rows=False)[0]['id']
+
+def insert_trademarks_bulk(records, page_size=500):
+    """
+    Upserts a batch of trademarks in one transaction with a set-based INSERT ... ON CONFLICT,
+    with the same semantics and description cleanup as insert_trademark. Returns one
+    {'serial_number', 'id', 'inserted'} dict per record, in input order (id None = failed).
+    If the batch fails as a whole, its records are retried one by one so a bad row only loses itself.
+    """
+    return _upsert_trademarks(records, retry_rows=True, page_size=page_size)
+
+def _upsert_trademarks(records, retry_rows, page_size=500):
+    if not records:
+        return []
+    # One statement cannot update a row twice, so the last record of a serial wins, as it
+    # would with sequential upserts. Records without a serial never conflict.
+    winner = {}
+    for n, data in enumerate(records):
+        _clean_description(data)
+        serial = data.get('serial_number')
+        winner[serial if serial is not None else ('row', n)] = n
+    order = sorted(winner.values())
 
+    conn = get_db_connection()
+    cur = conn.cursor()
     try:
-        cur.execute("""
-            INSERT INTO trademarks (
-                serial_number, int_reg_number, class_indices, registration_date, 
-                trademark_name, description, disclaimer, applicant_name, 
-                applicant_address, agent_details, logo_data, evidence_snapshot, 
-                text_embedding, logo_embedding, category, is_split,
-                batch_number, batch_year
-            )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (serial_number) DO UPDATE SET
-                trademark_name = EXCLUDED.trademark_name,
-                class_indices = EXCLUDED.class_indices,
-                description = EXCLUDED.description,
-                applicant_name = EXCLUDED.applicant_name,
-                applicant_address = EXCLUDED.applicant_address,
-                agent_details = EXCLUDED.agent_details,
-                logo_data = EXCLUDED.logo_data,
-                evidence_snapshot = EXCLUDED.evidence_snapshot,
-                text_embedding = EXCLUDED.text_embedding,
-                logo_embedding = EXCLUDED.logo_embedding,
-                batch_number = EXCLUDED.batch_number,
-                batch_year = EXCLUDED.batch_year;
-        """, (
-            data.get('serial_number'), data.get('int_reg_number'),
-            data.get('class_indices'), data.get('registration_date'),
-            data.get('trademark_name'), data.get('description'),
-            data.get('disclaimer'), data.get('applicant_name'),
-            data.get('applicant_address'), data.get('agent_details'),
-            data.get('logo_data'), data.get('evidence_snapshot'),
-            text_emb, logo_emb, data.get('category', 'MYIPO'),
-            data.get('is_split', False),
-            data.get('batch_number'),
-            data.get('batch_year')
-        ))
+        rows = psycopg2.extras.execute_values(cur, _TRADEMARK_UPSERT, [_trademark_row(records[n]) for n in order],
+                                              page_size=page_size, fetch=True)
+        # Rows come back in VALUES order
+        ids = {n: (row[0], row[2]) for n, row in zip(order, rows)}
+        by_category = {}
+        for n, (tm_id, _) in ids.items():
+            by_category.setdefault(records[n].get('category', 'MYIPO'), []).append(tm_id)
+        for category, tm_ids in by_category.items():
+            _emit_change(cur, 'trademarks', upserted=tm_ids, category=category)
         conn.commit()
+        error = None
     except Exception as e:
-        print(f"Upsert Error: {e}")
         conn.rollback()
+        error = e
     finally:
         cur.close(); conn.close()
 
+    if error is not None:
+        if not retry_rows or len(records) == 1:
+            print(f"Upsert Error: {error}")
+            return [{'serial_number': data.get('serial_number'), 'id': None, 'inserted': False} for data in records]
+        print(f"Bulk upsert of {len(records)} trademarks failed ({error}); retrying one by one.")
+        return [_upsert_trademarks([data], retry_rows=False)[0] for data in records]
+
+    # An upsert may overwrite an existing serial, so listeners replace rather than append
+    for category, tm_ids in by_category.items():
+        winners = [(ids[n][0], records[n]) for n in order if records[n].get('category', 'MYIPO') == category]
+        vectors = {
+            'logo': {tm_id: data['logo_embedding'] for tm_id, data in winners if data.get('logo_embedding') is not None},
+            'text': {tm_id: data['text_embedding'] for tm_id, data in winners if data.get('text_embedding') is not None},
+        }
+        metadata = {tm_id: {
+            'category':      data.get('category', 'MYIPO'),
+            'class_indices': data.get('class_indices'),
+            'batch_number':  data.get('batch_number'),
+            'batch_year':    data.get('batch_year'),
+        } for tm_id, data in winners}
+        _notify_write('trademarks', upserted=tm_ids, category=category, vectors=vectors, metadata=metadata)
+
+    results = []
+    for n, data in enumerate(records):
+        serial = data.get('serial_number')
+        tm_id, inserted = ids[winner[serial if serial is not None else ('row', n)]]
+        results.append({'serial_number': serial, 'id': tm_id, 'inserted': bool(inserted)})
+    return results
+
 def get_all_trademarks():
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cur.execute("""
-        SELECT id, serial_number, trademark_name, class_indices, applicant_name, category, is_split,
-               (logo_data IS NOT NULL) as has_logo,
-               batch_number, batch_year
-        FROM trademarks
-        ORDER BY id DESC
-    """)
-    trademarks = cur.fetchall()
-    cur.close(); conn.close()
+    with db_cursor(dict_cursor=True) as cur:
+        cur.execute("""
+            SELECT id, serial_number, trademark_name, class_indices, applicant_name, category, is_split,
+                   (logo_data IS NOT NULL) as has_logo,
+                   batch_number, batch_year
+            FROM trademarks
+            ORDER BY id DESC
+        """)
+        trademarks = cur.fetchall()
     return trademarks
 
 def get_all_trademarks_manageTab():
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cur.execute("""
-        SELECT id, serial_number, trademark_name, class_indices, applicant_name, description, category, is_split,
-            (logo_data IS NOT NULL) as has_logo,
-            batch_number, batch_year
-        FROM trademarks
-        ORDER BY id DESC
-    """)
-    trademarks = cur.fetchall()
-    cur.close(); conn.close()
+    with db_cursor(dict_cursor=True) as cur:
+        cur.execute("""
+            SELECT id, serial_number, trademark_name, class_indices, applicant_name, description, category, is_split,
+                (logo_data IS NOT NULL) as has_logo,
+                batch_number, batch_year
+            FROM trademarks
+            ORDER BY id DESC
+        """)
+        trademarks = cur.fetchall()
     return trademarks
 
 def get_logo(trademark_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT logo_data FROM trademarks WHERE id = %s", (trademark_id,))
-    logo_data = cur.fetchone()
-    cur.close(); conn.close()
+    with db_cursor() as cur:
+        cur.execute("SELECT logo_data FROM trademarks WHERE id = %s", (trademark_id,))
+        logo_data = cur.fetchone()
     return logo_data[0] if logo_data else None
 
 def get_evidence(trademark_id):
     """Fetches the full block evidence snapshot."""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT evidence_snapshot FROM trademarks WHERE id = %s", (trademark_id,))
-    data = cur.fetchone()
-    cur.close(); conn.close()
+    with db_cursor() as cur:
+        cur.execute("SELECT evidence_snapshot FROM trademarks WHERE id = %s", (trademark_id,))
+        data = cur.fetchone()
     return data[0] if data else None
 
+# --- STREAMING EMBEDDING LOADER ---
+# Index builds read every embedding. COPY ... (FORMAT binary) streams the rows and each BYTEA
+# is decoded straight into its row of a preallocated matrix, so no per-row Python objects or
+# intermediate lists are kept and peak memory is the matrices themselves.
+
+_COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+_INT_FORMATS = {2: '>h', 4: '>i', 8: '>q'}
+
+class _BinaryCopySink:
+    """File-like target for copy_expert: parses binary COPY tuples (integer keys, then BYTEA embeddings)."""
+
+    def __init__(self, n_rows, n_keys, dims):
+        self.n_keys   = n_keys
+        self.rows     = 0
+        self.keys     = np.zeros((n_rows, n_keys), dtype=np.int64)
+        self.matrices = [np.zeros((n_rows, dim), dtype=np.float32) for dim in dims]
+        self.valid    = [np.zeros(n_rows, dtype=bool) for _ in dims]
+        self._buf     = bytearray()
+        self._started = False
+
+    def _grow(self):
+        # Only if rows appeared after the count (the snapshot should prevent it)
+        extra = max(1024, self.rows)
+        self.keys     = np.concatenate([self.keys, np.zeros((extra, self.n_keys), dtype=np.int64)])
+        self.matrices = [np.concatenate([m, np.zeros((extra, m.shape[1]), dtype=np.float32)]) for m in self.matrices]
+        self.valid    = [np.concatenate([v, np.zeros(extra, dtype=bool)]) for v in self.valid]
+
+    def write(self, data):
+        buf = self._buf
+        buf += data
+        pos = 0
+        if not self._started:
+            if len(buf) < 19:
+                return len(data)
+            if bytes(buf[:11]) != _COPY_SIGNATURE:
+                raise ValueError("Not a binary COPY stream")
+            pos = 19 + struct.unpack_from('>I', buf, 15)[0]   # flags, then header extension length
+            self._started = True
+        end = len(buf)
+        with memoryview(buf) as view:
+            while end - pos >= 2:
+                n_fields = struct.unpack_from('>h', buf, pos)[0]
+                if n_fields == -1:          # trailer
+                    pos += 2
+                    break
+                fields, p = [], pos + 2
+                for _ in range(n_fields):
+                    if end - p < 4:
+                        break
+                    size = struct.unpack_from('>i', buf, p)[0]
+                    p += 4
+                    if size > end - p:
+                        break
+                    fields.append((p, size))
+                    p += max(size, 0)
+                if len(fields) < n_fields:
+                    break                   # tuple continues in the next chunk
+                self._add_row(buf, view, fields)
+                pos = p
+        del buf[:pos]
+        return len(data)
+
+    def _add_row(self, buf, view, fields):
+        if self.rows == len(self.keys):
+            self._grow()
+        row = self.rows
+        for k, (p, size) in enumerate(fields[:self.n_keys]):
+            self.keys[row, k] = struct.unpack_from(_INT_FORMATS[size], buf, p)[0]
+        for col, (p, size) in enumerate(fields[self.n_keys:]):
+            if size > 0:
+                self.valid[col][row] = decode_into(view[p:p + size], self.matrices[col][row])
+        self.rows += 1
+
+    def result(self):
+        n = self.rows
+        return self.keys[:n], [m[:n] for m in self.matrices], [v[:n] for v in self.valid]
+
+def stream_embedding_matrices(query, params=(), n_keys=1, dims=()):
+    """
+    Runs `query` (n_keys integer columns, then one BYTEA embedding column per entry of dims)
+    through COPY ... TO STDOUT (FORMAT binary). Returns (keys (n, n_keys) int64, [float32 (n, dim)
+    matrices], [validity masks]): row i of every array is the same database row.
+    """
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            # Count and COPY must see the same rows to size the matrices exactly
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+            cur.execute(f"SELECT count(*) FROM ({query}) q", params)
+            sink = _BinaryCopySink(cur.fetchone()[0], n_keys, dims)
+            copy_sql = cur.mogrify(f"COPY ({query}) TO STDOUT (FORMAT binary)", params).decode()
+            cur.copy_expert(copy_sql, sink, size=1 << 20)
+        finally:
+            cur.close()
+    return sink.result()
+
+def _embedding_columns(query, params=()):
+    keys, (text, logo), (text_valid, logo_valid) = stream_embedding_matrices(query, params, n_keys=1, dims=(384, 512))
+    return {
+        'ids':        keys[:, 0],
+        'text':       text,
+        'text_valid': text_valid,
+        'logo':       logo,
+        'logo_valid': logo_valid,
+    }
+
 def get_all_embeddings(category=None):
-    """Fetches embeddings for building the FAISS index."""
+    """
+    Fetches embeddings for building the FAISS index. Every array is id-aligned: row i of
+    'text' / 'logo' belongs to ids[i], and 'text_valid' / 'logo_valid' mark the rows that have one.
+    """
+    if category:
+        return _embedding_columns("SELECT id, text_embedding, logo_embedding FROM trademarks WHERE category = %s ORDER BY id",
+                                  (category,))
+    return _embedding_columns("SELECT id, text_embedding, logo_embedding FROM trademarks ORDER BY id")
+
+def replace_logo_components(trademark_id, components):
+    """
+    Replaces the stored components of one trademark.
+    components: list of dicts with component_no, bbox, area, ink_ratio, embedding.
+    """
+    replace_logo_components_bulk({trademark_id: components})
+
+def replace_logo_components_bulk(components_by_id):
+    """replace_logo_components for many trademarks ({trademark_id: components}) in one transaction."""
+    if not components_by_id:
+        return
+    tm_ids = list(components_by_id)
     conn = get_db_connection()
     cur = conn.cursor()
-    if category:
-        cur.execute("SELECT id, text_embedding, logo_embedding FROM trademarks WHERE category = %s", (category,))
-    else:
-        cur.execute("SELECT id, text_embedding, logo_embedding FROM trademarks")
-    rows = cur.fetchall()
-    cur.close(); conn.close()
+    try:
+        cur.execute("DELETE FROM logo_components WHERE trademark_id = ANY(%s)", (tm_ids,))
+        rows = [(tm_id, c['component_no'], [int(v) for v in c['bbox']], int(c['area']),
+                 float(c['ink_ratio']), psycopg2.Binary(encode_embedding(c['embedding'])))
+                for tm_id, components in components_by_id.items() for c in components]
+        if rows:
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO logo_components (trademark_id, component_no, bbox, area, ink_ratio, embedding)
+                VALUES %s
+            """, rows)
+        _emit_change(cur, 'logo_components', upserted=tm_ids)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close(); conn.close()
 
-    db_data = {'text': [], 'logo': [], 'ids': []}
-    for row in rows:
-        db_id, text_bytes, logo_bytes = row
-        db_data['ids'].append(db_id)
-        if text_bytes:
-            db_data['text'].append(np.frombuffer(text_bytes, dtype=np.float32))
-        if logo_bytes:
-            db_data['logo'].append(np.frombuffer(logo_bytes, dtype=np.float32))
-        else:
-            db_data['logo'].append(np.zeros(512, dtype=np.float32))
-    return db_data
+    vectors = {'components': {(tm_id, c['component_no']): c['embedding']
+                              for tm_id, components in components_by_id.items() for c in components}}
+    _notify_write('logo_components', upserted=tm_ids, vectors=vectors)
+
+def get_all_component_embeddings(trademark_ids=None):
+    """Stored logo components (optionally of some marks only): (trademark_id, component_no) keys plus a (n, 512) matrix."""
+    query = "SELECT trademark_id, component_no, embedding FROM logo_components"
+    params = ()
+    if trademark_ids is not None:
+        query += " WHERE trademark_id = ANY(%s)"
+        params = (list(trademark_ids),)
+    keys, (matrix,), (valid,) = stream_embedding_matrices(query, params, n_keys=2, dims=(512,))
+    return {
+        'keys':       [tuple(k) for k in keys[valid].tolist()],
+        'embeddings': matrix if valid.all() else matrix[valid]
+    }
+
+def get_dataset_version(table_name='trademarks'):
+    """Returns '<max id>:<change counter>' for a table; any insert/update/delete changes it."""
+    if table_name not in ('trademarks', 'client_trademarks', 'logo_components'):
+        raise ValueError(f"Unknown table {table_name}")
+    with db_cursor() as cur:
+        cur.execute(f"""
+            SELECT COALESCE((SELECT MAX(id) FROM {table_name}), 0),
+                   COALESCE((SELECT change_counter FROM dataset_version WHERE table_name = %s), 0)
+        """, (table_name,))
+        max_id, counter = cur.fetchone()
+    return f"{max_id}:{counter}"
 
 def delete_trademark_by_id(trademark_id):
     conn = get_db_connection()
     cur = conn.cursor()
     try:
-        cur.execute("DELETE FROM trademarks WHERE id = %s", (trademark_id,))
+        cur.execute("DELETE FROM trademarks WHERE id = %s RETURNING category", (trademark_id,))
+        row = cur.fetchone()
+        if row:
+            _emit_change(cur, 'trademarks', deleted=[trademark_id], category=row[0])
         conn.commit()
     except Exception:
         conn.rollback()
@@ -377,25 +961,160 @@ def delete_trademark_by_id(trademark_id):
     finally:
         cur.close()
         conn.close()
+    if row:
+        _notify_write('trademarks', deleted=[trademark_id], category=row[0])
+
+def get_index_ids():
+    """Ids that should be in the logo / text FAISS indexes (used by the consistency check)."""
+    with db_cursor() as cur:
+        cur.execute("""
+            SELECT id, logo_embedding IS NOT NULL, text_embedding IS NOT NULL
+            FROM trademarks
+            WHERE logo_embedding IS NOT NULL OR text_embedding IS NOT NULL
+        """)
+        rows = cur.fetchall()
+    return {
+        'logo': {r[0] for r in rows if r[1]},
+        'text': {r[0] for r in rows if r[2]}
+    }
+
+def get_index_metadata(ids=None):
+    """Filterable fields (category, classes, batch) of every indexed trademark (or of `ids`), for filtered vector search."""
+    with db_cursor(dict_cursor=True) as cur:
+        query = """
+            SELECT id, category, class_indices, batch_number, batch_year
+            FROM trademarks
+            WHERE (logo_embedding IS NOT NULL OR text_embedding IS NOT NULL)
+        """
+        if ids is not None:
+            cur.execute(query + " AND id = ANY(%s)", (list(ids),))
+        else:
+            cur.execute(query)
+        rows = cur.fetchall()
+    return rows
+
+def get_embeddings_by_ids(ids):
+    """Same shape as get_all_embeddings, restricted to the given trademark ids."""
+    return _embedding_columns("SELECT id, text_embedding, logo_embedding FROM trademarks WHERE id = ANY(%s) ORDER BY id",
+                              (list(ids),))
+
+def migrate_embedding_storage(dtype, batch_size=500):
+    """Re-encodes every stored embedding in the given storage dtype, one transaction per batch."""
+    from embedding_format import decode_embedding
+    counts = {}
+    for table, columns in (('trademarks', ('text_embedding', 'logo_embedding')),
+                           ('client_trademarks', ('logo_embedding',))):
+        counts[table] = 0
+        last_id = 0
+        while True:
+            conn = get_db_connection()
+            cur = conn.cursor()
+            try:
+                cur.execute(f"SELECT id, {', '.join(columns)} FROM {table} WHERE id > %s ORDER BY id LIMIT %s",
+                            (last_id, batch_size))
+                rows = cur.fetchall()
+                if not rows:
+                    break
+                for row in rows:
+                    values = []
+                    for blob in row[1:]:
+                        vec = decode_embedding(bytes(blob)) if blob else None
+                        values.append(psycopg2.Binary(encode_embedding(vec, dtype)) if vec is not None else None)
+                    sets = ', '.join(f"{c} = %s" for c in columns)
+                    cur.execute(f"UPDATE {table} SET {sets} WHERE id = %s", (*values, row[0]))
+                conn.commit()
+                counts[table] += len(rows)
+                last_id = rows[-1][0]
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cur.close(); conn.close()
+    return counts
+
 # ==============================================================================
-# SEARCH FUNCTIONS 
+# EMBEDDING CACHE FUNCTIONS
 # ==============================================================================
 
-def search_trademarks(words=None, class_filter=None, id_list=None):
+def get_cached_embeddings(keys):
+    """Returns {cache_key: embedding bytes} for the keys present, touching last_used for LRU eviction."""
+    if not keys:
+        return {}
     conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            UPDATE embedding_cache SET last_used = CURRENT_TIMESTAMP
+            WHERE cache_key = ANY(%s)
+            RETURNING cache_key, embedding
+        """, ([psycopg2.Binary(k) for k in keys],))
+        rows = cur.fetchall()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close(); conn.close()
+    return {bytes(k): bytes(emb) for k, emb in rows}
 
-    query = """
-        SELECT id, 
-               serial_number, 
-               class_indices, 
-               applicant_name, 
-               agent_details, 
-               description,
-               (logo_data IS NOT NULL) as has_logo 
-        FROM trademarks
+def put_cached_embeddings(rows):
+    """rows: list of (cache_key, model_name, embedding bytes)."""
+    if not rows:
+        return
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO embedding_cache (cache_key, model_name, embedding)
+            VALUES %s
+            ON CONFLICT (cache_key) DO UPDATE SET last_used = CURRENT_TIMESTAMP
+        """, [(psycopg2.Binary(k), m, psycopg2.Binary(e)) for k, m, e in rows])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close(); conn.close()
+
+def evict_embedding_cache(max_rows):
+    """Deletes the least recently used cache rows beyond max_rows. Returns the number deleted."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            DELETE FROM embedding_cache WHERE cache_key IN (
+                SELECT cache_key FROM embedding_cache
+                ORDER BY last_used DESC
+                OFFSET %s
+            )
+        """, (max_rows,))
+        deleted = cur.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close(); conn.close()
+    return deleted
+
+# ==============================================================================
+# SEARCH FUNCTIONS 
+# ==============================================================================
+
+def class_filter_sql(class_filter, class_match='any', column='class_numbers'):
     """
-    # Allow Serial Number Search
+    (clause, params) for a class filter on the int[] column: 'any' (&&) keeps marks in at
+    least one of the classes, 'all' (@>) marks in every one. Exact: class 5 never matches 15.
+    """
+    classes = nice_classes(class_filter)
+    if not classes:
+        return "FALSE", []
+    operator = "@>" if class_match == 'all' else "&&"
+    return f"{column} {operator} %s::int[]", [classes]
+
+def _trademark_filters(words=None, class_filter=None, id_list=None, batch_number=None, batch_year=None, category=None,
+                       class_match='any'):
+    """WHERE clauses + params shared by search_trademarks and get_trademarks_page."""
     where_clauses = []
     params = []
 
@@ -403,50 +1122,232 @@ def search_trademarks(words=None, class_filter=None, id_list=None):
         clean_words = words.strip().replace(" ", "")
         term = f"%{clean_words}%"
 
+        # Each branch is served by a trigram GIN index (see init_db), so no sequential scan
         where_clauses.append("""
         (
             trademark_name ILIKE %s
         OR applicant_name ILIKE %s
-        OR REGEXP_REPLACE(serial_number, '\\s+', '', 'g') ILIKE %s
+        OR serial_normalized LIKE lower(%s)
         OR description ILIKE %s
         )
         """)
         params.extend([term, term, term, term])
 
-    if class_filter and class_filter.strip():
-        where_clauses.append("class_indices ILIKE %s")
-        params.append(f"%{class_filter.strip()}%")
+    if class_filter and str(class_filter).strip():
+        clause, clause_params = class_filter_sql(class_filter, class_match)
+        where_clauses.append(clause)
+        params.extend(clause_params)
 
     if id_list:
         where_clauses.append("id = ANY(%s)")
         params.append(id_list)
 
+    if batch_number:
+        where_clauses.append("batch_number = %s")
+        params.append(str(batch_number))
+
+    if batch_year:
+        where_clauses.append("batch_year = %s")
+        params.append(str(batch_year))
+
+    if category:
+        where_clauses.append("category = %s")
+        params.append(category.upper())
+
+    return where_clauses, params
+
+def _parse_search_cursor(after, ranked):
+    """'score:id' (ranked searches) or 'id' -> (score, id) / (None, id). ValueError if malformed."""
+    score, sep, tm_id = str(after).rpartition(":")
+    if ranked != bool(sep):
+        raise ValueError("'after' does not belong to this search")
+    return (float(score) if sep else None), int(tm_id)
+
+def search_trademarks(words=None, class_filter=None, id_list=None, limit=None, mode='substring', class_match='any',
+                      after=None):
+    """
+    Filtered trademark rows. With `words`, best matches come first (with their `score`): an exact
+    serial, then trigram word similarity to the name / applicant (description counts half).
+    mode='fulltext' matches words as a web-style query against search_vector instead (see
+    fulltext_search_trademarks). class_match='all' requires every class in class_filter.
+    `after` is a cursor from search_trademarks_page: only rows ranked below it are returned.
+    """
+    if mode == 'fulltext' and words and words.strip():
+        return fulltext_search_trademarks(words, class_filter=class_filter, id_list=id_list, limit=limit,
+                                          class_match=class_match, after=after)
+
+    ranked = bool(words and words.strip())
+    score_sql = "NULL::real"
+    score_params = []
+    if ranked:
+        term = words.strip()
+        # Cast to real so a score handed back in a cursor compares exactly
+        score_sql = """
+            GREATEST(
+                CASE WHEN serial_normalized = lower(%s) THEN 1.0 ELSE 0.0 END,
+                word_similarity(%s, COALESCE(trademark_name, '')),
+                word_similarity(%s, COALESCE(applicant_name, '')),
+                0.5 * word_similarity(%s, COALESCE(description, ''))
+            )::real
+        """
+        score_params = [term.replace(" ", ""), term, term, term]
+
+    query = f"""
+        SELECT id, 
+               serial_number, 
+               class_indices, 
+               applicant_name, 
+               agent_details, 
+               description,
+               (logo_data IS NOT NULL) as has_logo,
+               {score_sql} AS score
+        FROM trademarks
+    """
+    params = list(score_params)
+    # Allow Serial Number Search
+    where_clauses, filter_params = _trademark_filters(words, class_filter, id_list, class_match=class_match)
+    params.extend(filter_params)
     if where_clauses:
         query += " WHERE " + " AND ".join(where_clauses)
 
-    query += " ORDER BY id DESC"
+    if ranked:
+        query = f"SELECT * FROM ({query}) ranked"
+        if after is not None:
+            score, last_id = _parse_search_cursor(after, ranked=True)
+            query += " WHERE (score, id) < (%s::real, %s)"
+            params.extend([score, last_id])
+        query += " ORDER BY score DESC, id DESC"
+    else:
+        if after is not None:
+            _, last_id = _parse_search_cursor(after, ranked=False)
+            query += (" AND" if where_clauses else " WHERE") + " id < %s"
+            params.append(last_id)
+        query += " ORDER BY id DESC"
+    if limit:
+        query += " LIMIT %s"
+        params.append(int(limit))
 
-    cur.execute(query, tuple(params))
-    trademarks = cur.fetchall()
-    cur.close()
-    conn.close()
+    with db_cursor(dict_cursor=True) as cur:
+        cur.execute(query, tuple(params))
+        trademarks = cur.fetchall()
 
     return trademarks
+
+def search_trademarks_page(limit=50, after=None, words=None, class_filter=None, mode='substring', class_match='any'):
+    """
+    One page of search_trademarks results in its ranking order, keyset-paginated like
+    get_trademarks_page: pass the returned next_after back as `after` (None = no more rows).
+    Ranked searches use a 'score:id' cursor, unranked ones the plain id, so the first page of
+    get_trademarks_page continues here. Returns (rows, next_after); ValueError on a bad cursor.
+    """
+    rows = search_trademarks(words=words, class_filter=class_filter, limit=limit + 1, mode=mode,
+                             class_match=class_match, after=after)
+    next_after = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        rank = last.get('rank', last.get('score'))
+        next_after = f"{rank!r}:{last['id']}" if rank is not None else str(last['id'])
+    return rows[:limit], next_after
+
+FULLTEXT_DEFAULT_LIMIT = 50
+_SNIPPET_START, _SNIPPET_STOP = '\ue000', '\ue001'   # private-use chars marking ts_headline hits
+
+def fulltext_search_trademarks(words, class_filter=None, id_list=None, limit=None, class_match='any', after=None):
+    """
+    ts_rank-ordered full-text matches for a websearch-style query ("red apple", "shoes -socks",
+    "\"exact phrase\""). Rows carry `rank` and a `snippet` of the goods / services with the
+    matched terms wrapped in <mark>. `snippet` is safe HTML: the extracted text is escaped and
+    <mark> is the only markup. Only the top `limit` rows are ranked into snippets.
+    """
+    where_clauses, params = _trademark_filters(None, class_filter, id_list, class_match=class_match)
+    where_clauses.insert(0, "search_vector @@ (SELECT query FROM q)")
+    limit = int(limit or FULLTEXT_DEFAULT_LIMIT)
+    if after is not None:
+        rank, last_id = _parse_search_cursor(after, ranked=True)
+        where_clauses.append("(ts_rank(search_vector, (SELECT query FROM q)), id) < (%s::real, %s)")
+        params.extend([rank, last_id])
+
+    query = f"""
+        WITH q AS (SELECT websearch_to_tsquery('english', %s) AS query),
+        hits AS (
+            SELECT id, ts_rank(search_vector, (SELECT query FROM q)) AS rank
+            FROM trademarks
+            WHERE {" AND ".join(where_clauses)}
+            ORDER BY rank DESC, id DESC
+            LIMIT %s
+        )
+        SELECT t.id,
+               t.serial_number,
+               t.class_indices,
+               t.applicant_name,
+               t.agent_details,
+               t.description,
+               (t.logo_data IS NOT NULL) as has_logo,
+               hits.rank,
+               ts_headline('english', translate(COALESCE(NULLIF(t.description, ''), t.trademark_name, ''), %s, ''),
+                           (SELECT query FROM q), %s) AS snippet
+        FROM hits JOIN trademarks t ON t.id = hits.id
+        ORDER BY hits.rank DESC, t.id DESC
+    """
+    # ts_headline does not escape the source text: highlight with sentinels (stripped from the
+    # text first), then escape and swap them for <mark> here
+    options = (f'StartSel="{_SNIPPET_START}", StopSel="{_SNIPPET_STOP}", '
+               f'MaxFragments=2, MaxWords=20, MinWords=5')
+    with db_cursor(dict_cursor=True) as cur:
+        cur.execute(query, (words.strip(), *params, limit, _SNIPPET_START + _SNIPPET_STOP, options))
+        rows = cur.fetchall()
+    for row in rows:
+        row['snippet'] = (html.escape(row['snippet'] or '')
+                          .replace(_SNIPPET_START, '<mark>').replace(_SNIPPET_STOP, '</mark>'))
+    return rows
+
+def get_trademarks_page(limit=50, after=None, with_total=False, words=None, class_filter=None,
+                        batch_number=None, batch_year=None, category=None, class_match='any'):
+    """
+    One page of trademarks, newest first, with keyset pagination on id: pass the returned
+    next_after back as `after` for the following page (None = no more rows).
+    Returns (rows, next_after, total); total is only counted when with_total is set.
+    """
+    where_clauses, params = _trademark_filters(words, class_filter, None, batch_number, batch_year, category, class_match)
+    total = None
+    with db_cursor(dict_cursor=True) as cur:
+        if with_total:
+            count_sql = "SELECT COUNT(*) FROM trademarks"
+            if where_clauses:
+                count_sql += " WHERE " + " AND ".join(where_clauses)
+            cur.execute(count_sql, tuple(params))
+            total = cur.fetchone()[0]
+
+        if after is not None:
+            where_clauses.append("id < %s")
+            params.append(int(after))
+        query = """
+            SELECT id, serial_number, trademark_name, class_indices, applicant_name, agent_details,
+                   description, category, is_split, (logo_data IS NOT NULL) as has_logo,
+                   batch_number, batch_year
+            FROM trademarks
+        """
+        if where_clauses:
+            query += " WHERE " + " AND ".join(where_clauses)
+        # One extra row tells us whether another page exists
+        query += " ORDER BY id DESC LIMIT %s"
+        cur.execute(query, tuple(params) + (limit + 1,))
+        rows = cur.fetchall()
+
+    next_after = rows[limit - 1]['id'] if len(rows) > limit else None
+    return rows[:limit], next_after, total
 # ==============================================================================
 # GET QUERY (COMPARE)
 # ==============================================================================
 def get_query_items_by_category(category):
     """Fetches full trademark data to be used as query items for comparison."""
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cur.execute("""
-        SELECT serial_number, trademark_name, description, logo_data 
-        FROM trademarks 
-        WHERE category = %s
-    """, (category,))
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
+    with db_cursor(dict_cursor=True) as cur:
+        cur.execute("""
+            SELECT serial_number, trademark_name, description, logo_data 
+            FROM trademarks 
+            WHERE category = %s
+        """, (category,))
+        rows = cur.fetchall()
     
     # Format to match what the search loop expects
     return [dict(r) for r in rows]
\ No newline at end of file
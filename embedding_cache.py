@@ -0,0 +1,123 @@
+# embedding_cache.py
+"""
+Content-addressed embedding cache used transparently by MLModel.
+
+Keys are SHA-256(model name + image bytes / normalized text). Lookups go to an
+in-process LRU first, then to the `embedding_cache` table in Postgres. Both tiers
+are size-bounded; the DB tier evicts its least recently used rows.
+"""
+
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import database as db
+from embedding_format import encode_embedding, decode_embedding
+
+
+def normalize_text(text):
+    """Collapses whitespace so trivially different strings share one cache entry."""
+    return re.sub(r'\s+', ' ', text or '').strip()
+
+
+class EmbeddingCache:
+    def __init__(self, memory_size=None, persistent=None, max_persistent_rows=None, evict_every=500):
+        self.memory_size = int(memory_size if memory_size is not None else os.getenv('EMBED_CACHE_SIZE', 20000))
+        if persistent is None:
+            persistent = os.getenv('EMBED_CACHE_PERSIST', 'True') == 'True'
+        self.persistent = persistent
+        self.max_persistent_rows = int(max_persistent_rows if max_persistent_rows is not None
+                                       else os.getenv('EMBED_CACHE_DB_ROWS', 200000))
+        self.evict_every = evict_every
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes_since_evict = 0
+        self.counters = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'memory_evictions': 0, 'db_evictions': 0}
+
+    @staticmethod
+    def make_key(model_name, payload):
+        """payload is raw image bytes or an already-normalized text string."""
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        h = hashlib.sha256(model_name.encode('utf-8'))
+        h.update(b'\0')
+        h.update(payload)
+        return h.digest()
+
+    def get_many(self, keys):
+        """Returns {key: float32 vector} for every key found in either tier."""
+        found, missing = {}, []
+        with self._lock:
+            for key in keys:
+                vec = self._memory.get(key)
+                if vec is not None:
+                    self._memory.move_to_end(key)
+                    found[key] = vec
+                    self.counters['memory_hits'] += 1
+                else:
+                    missing.append(key)
+
+        if missing and self.persistent:
+            try:
+                rows = db.get_cached_embeddings(missing)
+            except Exception as e:
+                print(f"Embedding cache DB lookup failed: {e}")
+                rows = {}
+            for key, blob in rows.items():
+                vec = decode_embedding(blob)
+                if vec is None:
+                    continue
+                found[key] = vec
+                self._remember(key, vec)
+            with self._lock:
+                self.counters['db_hits'] += len(rows)
+
+        with self._lock:
+            self.counters['misses'] += len(set(keys) - found.keys())
+        return found
+
+    def put_many(self, entries, model_name):
+        """entries: {key: normalized float32 vector}. Writes through to both tiers."""
+        if not entries:
+            return
+        for key, vec in entries.items():
+            self._remember(key, np.asarray(vec, dtype=np.float32))
+
+        if not self.persistent:
+            return
+        try:
+            db.put_cached_embeddings([(key, model_name, encode_embedding(vec))
+                                      for key, vec in entries.items()])
+            self._writes_since_evict += len(entries)
+            if self._writes_since_evict >= self.evict_every:
+                self._writes_since_evict = 0
+                evicted = db.evict_embedding_cache(self.max_persistent_rows)
+                with self._lock:
+                    self.counters['db_evictions'] += evicted
+        except Exception as e:
+            print(f"Embedding cache DB write failed: {e}")
+
+    def _remember(self, key, vec):
+        with self._lock:
+            self._memory[key] = vec
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+                self.counters['memory_evictions'] += 1
+
+    def clear_memory(self):
+        with self._lock:
+            self._memory.clear()
+
+    def stats(self):
+        with self._lock:
+            s = dict(self.counters)
+            s['memory_entries'] = len(self._memory)
+        lookups = s['memory_hits'] + s['db_hits'] + s['misses']
+        s['hit_rate'] = round((s['memory_hits'] + s['db_hits']) / lookups, 4) if lookups else 0.0
+        s['persistent'] = self.persistent
+        return s
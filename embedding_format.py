@@ -0,0 +1,105 @@
+# embedding_format.py
+"""
+Versioned on-disk format for the text_embedding / logo_embedding BYTEA columns.
+
+    header  = MAGIC (4s) | version (B) | dtype code (B) | dim (H) | scale (f)   -- 12 bytes, little-endian
+    payload = dim values of float32 / float16 / int8
+
+int8 is symmetric scalar quantization with one scale per vector. Blobs without
+the header are the legacy raw float32 `tobytes()` rows and still decode.
+
+Re-encode existing rows with:
+    python embedding_format.py migrate --dtype float16
+"""
+
+import argparse
+import os
+import struct
+
+import numpy as np
+
+MAGIC   = b"\x93EMB"
+VERSION = 1
+HEADER  = struct.Struct("<4sBBHf")
+
+DTYPE_CODES = {"float32": 0, "float16": 1, "int8": 2}
+CODE_DTYPES = {v: k for k, v in DTYPE_CODES.items()}
+NP_DTYPES   = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+
+def storage_dtype():
+    """Encoding used for new rows (EMBEDDING_STORAGE_DTYPE, default float16)."""
+    dtype = os.getenv("EMBEDDING_STORAGE_DTYPE", "float16").lower()
+    if dtype not in DTYPE_CODES:
+        raise ValueError(f"Unsupported EMBEDDING_STORAGE_DTYPE '{dtype}'")
+    return dtype
+
+
+def encode_embedding(vec, dtype=None):
+    """float vector -> header + payload bytes."""
+    dtype = dtype or storage_dtype()
+    vec = np.asarray(vec, dtype=np.float32).ravel()
+    scale = 0.0
+    if dtype == "int8":
+        peak = float(np.abs(vec).max()) if vec.size else 0.0
+        scale = peak / 127.0 if peak > 0 else 1.0
+        payload = np.clip(np.rint(vec / scale), -127, 127).astype(np.int8)
+    else:
+        payload = vec.astype(NP_DTYPES[dtype])
+    return HEADER.pack(MAGIC, VERSION, DTYPE_CODES[dtype], vec.size, scale) + payload.tobytes()
+
+
+def read_header(blob):
+    """Returns (dtype, dim, scale, payload offset); legacy blobs report float32 with no header."""
+    if len(blob) >= HEADER.size and bytes(blob[:4]) == MAGIC:
+        _, version, code, dim, scale = HEADER.unpack_from(blob)
+        if version != VERSION:
+            raise ValueError(f"Unknown embedding format version {version}")
+        return CODE_DTYPES[code], dim, scale, HEADER.size
+    return "float32", len(blob) // 4, 0.0, 0
+
+
+def decode_into(blob, out):
+    """Decodes blob directly into the preallocated row `out` (float32 or float16). Returns False on bad blobs."""
+    if not blob:
+        return False
+    dtype, dim, scale, offset = read_header(blob)
+    if dim != out.shape[-1]:
+        return False
+    values = np.frombuffer(blob, dtype=NP_DTYPES[dtype], count=dim, offset=offset)
+    if dtype == "int8":
+        np.multiply(values, scale, out=out, casting="unsafe")
+    else:
+        out[...] = values
+    return True
+
+
+def decode_embedding(blob):
+    """blob -> standalone float32 vector (None for empty blobs)."""
+    if not blob:
+        return None
+    _, dim, _, _ = read_header(blob)
+    out = np.empty(dim, dtype=np.float32)
+    return out if decode_into(blob, out) else None
+
+
+def decode_matrix(blobs, dim, dtype=np.float32):
+    """Decodes a list of blobs into one (n, dim) matrix plus a validity mask."""
+    matrix = np.zeros((len(blobs), dim), dtype=dtype)
+    valid = np.zeros(len(blobs), dtype=bool)
+    for i, blob in enumerate(blobs):
+        valid[i] = decode_into(blob, matrix[i])
+    return matrix, valid
+
+
+if __name__ == "__main__":
+    import database as db
+
+    parser = argparse.ArgumentParser(description="Embedding storage format tools.")
+    parser.add_argument("command", choices=["migrate"])
+    parser.add_argument("--dtype", default=storage_dtype(), choices=sorted(DTYPE_CODES))
+    parser.add_argument("--batch", type=int, default=500, help="rows re-encoded per transaction")
+    args = parser.parse_args()
+
+    counts = db.migrate_embedding_storage(args.dtype, batch_size=args.batch)
+    print(f"Re-encoded embeddings as {args.dtype}: {counts}")
@@ -0,0 +1,214 @@
+# embedding_server.py
+"""
+Shared embedding sidecar for multi-worker deployments.
+
+One process owns CLIP + MiniLM and batches encode requests coming from every
+web worker, so RAM stays flat as gunicorn workers are added:
+
+    python embedding_server.py --address /tmp/marklogic-embed.sock      # Unix socket
+    python embedding_server.py --address 127.0.0.1:7601                 # localhost TCP
+
+Workers then run with ML_BACKEND=remote and EMBED_SERVER_ADDRESS pointing at the
+same address. Both sides must share EMBED_SERVER_AUTHKEY (connections are HMAC
+authenticated by multiprocessing.connection, which unpickles what it receives, so
+there is no default key). The server only binds TCP on loopback unless
+EMBED_SERVER_ALLOW_REMOTE=True, and the Unix socket is created owner-only (0600).
+"""
+
+import argparse
+import ipaddress
+import os
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+from PIL import Image
+
+from micro_batcher import MicroBatcher
+
+DEFAULT_ADDRESS = "/tmp/marklogic-embed.sock"
+
+
+def parse_address(address):
+    """'host:port' -> ('host', port) for TCP, anything else is a Unix socket path."""
+    address = address or os.getenv("EMBED_SERVER_ADDRESS", DEFAULT_ADDRESS)
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and "/" not in address:
+        return (host or "127.0.0.1", int(port))
+    return address
+
+
+def _is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def _authkey():
+    key = os.getenv("EMBED_SERVER_AUTHKEY")
+    if not key:
+        raise RuntimeError("EMBED_SERVER_AUTHKEY is not set; refusing to use the embedding server without a shared secret")
+    return key.encode()
+
+
+def _pack_images(images):
+    """PIL images -> picklable (mode, size, raw bytes) tuples."""
+    return [("RGB", img.size, img.convert("RGB").tobytes()) for img in images]
+
+
+def _unpack_images(packed):
+    return [Image.frombytes(mode, tuple(size), data) for mode, size, data in packed]
+
+# ==============================================================================
+# SERVER
+# ==============================================================================
+
+class EmbeddingServer:
+    def __init__(self, backend, address, batch_size=32, max_batch_items=64, max_wait_ms=5):
+        self.backend = backend
+        self.address = parse_address(address)
+        if (isinstance(self.address, tuple) and not _is_loopback(self.address[0])
+                and os.getenv("EMBED_SERVER_ALLOW_REMOTE", "False") != "True"):
+            raise RuntimeError(f"Refusing to bind {self.address[0]}: the embedding server only listens on "
+                               f"loopback unless EMBED_SERVER_ALLOW_REMOTE=True")
+        self.batch_size = batch_size
+        # One micro-batcher per modality merges requests from all connected workers
+        self.batchers = {
+            "images": MicroBatcher(lambda items: backend.encode_images(items, batch_size),
+                                   max_batch_items=max_batch_items, max_wait_ms=max_wait_ms, name="images"),
+            "texts":  MicroBatcher(lambda items: backend.encode_texts(items, batch_size),
+                                   max_batch_items=max_batch_items, max_wait_ms=max_wait_ms, name="texts"),
+        }
+
+    def stats(self):
+        return {kind: b.stats() for kind, b in self.batchers.items()}
+
+    def _serve_connection(self, conn):
+        try:
+            while True:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    return
+                op = request.get("op")
+                if op == "ping":
+                    conn.send({"ok": True, "backend": self.backend.name, "stats": self.stats()})
+                    continue
+                if op not in self.batchers:
+                    conn.send({"ok": False, "error": f"unknown op {op!r}"})
+                    continue
+
+                items = _unpack_images(request["items"]) if op == "images" else request["items"]
+                try:
+                    conn.send({"ok": True, "embeddings": self.batchers[op].submit(items)})
+                except Exception as e:
+                    conn.send({"ok": False, "error": str(e)})
+        finally:
+            conn.close()
+
+    def _listen(self, authkey):
+        if not isinstance(self.address, str):
+            return Listener(self.address, authkey=authkey)
+        if os.path.exists(self.address):
+            os.unlink(self.address)  # stale socket from a previous run
+        # Create the socket owner-only so other local users cannot even connect
+        old_umask = os.umask(0o177)
+        try:
+            listener = Listener(self.address, authkey=authkey)
+        finally:
+            os.umask(old_umask)
+        os.chmod(self.address, 0o600)
+        return listener
+
+    def serve_forever(self):
+        authkey = _authkey()  # fail before loading the models
+        print(f"[EmbedServer] Loading models ({self.backend.name} backend)...")
+        self.backend.load()
+
+        listener = self._listen(authkey)
+        print(f"[EmbedServer] Listening on {self.address}")
+
+        try:
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    print(f"[EmbedServer] Rejected connection: {e}")
+                    continue
+                threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+
+# ==============================================================================
+# CLIENT BACKEND (ML_BACKEND=remote)
+# ==============================================================================
+
+class RemoteBackend:
+    """Same interface as ml_utils.TorchBackend; forwards encode calls to the sidecar."""
+    name = "remote"
+
+    def __init__(self, address=None, connect_timeout=None):
+        self.address = parse_address(address)
+        self.authkey = _authkey()
+        self.connect_timeout = float(connect_timeout if connect_timeout is not None
+                                     else os.getenv("EMBED_SERVER_CONNECT_TIMEOUT", 60))
+        self._local = threading.local()  # one connection per thread: Connection is not thread-safe
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = Client(self.address, authkey=self.authkey)
+            self._local.conn = conn
+        return conn
+
+    def _call(self, request):
+        for attempt in (1, 2):
+            try:
+                conn = self._connection()
+                conn.send(request)
+                response = conn.recv()
+                break
+            except (OSError, EOFError):
+                # Server restarted: reconnect once before giving up
+                self._local.conn = None
+                if attempt == 2:
+                    raise
+        if not response.get("ok"):
+            raise RuntimeError(f"Embedding server error: {response.get('error')}")
+        return response
+
+    def load(self):
+        """Waits for the sidecar to come up (it may still be loading its models)."""
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            try:
+                info = self._call({"op": "ping"})
+                print(f"[MLModel] Connected to embedding server at {self.address} ({info['backend']} backend)")
+                return
+            except (OSError, EOFError):
+                if time.monotonic() >= deadline:
+                    raise RuntimeError(f"Embedding server not reachable at {self.address}")
+                time.sleep(1.0)
+
+    def encode_images(self, images, batch_size):
+        return self._call({"op": "images", "items": _pack_images(images)})["embeddings"]
+
+    def encode_texts(self, texts, batch_size):
+        return self._call({"op": "texts", "items": list(texts)})["embeddings"]
+
+
+if __name__ == "__main__":
+    from ml_utils import make_backend
+
+    parser = argparse.ArgumentParser(description="Run the shared MarkLogic embedding server.")
+    parser.add_argument("--address", default=os.getenv("EMBED_SERVER_ADDRESS", DEFAULT_ADDRESS))
+    parser.add_argument("--backend", default=os.getenv("EMBED_SERVER_BACKEND", "torch"), choices=["torch", "onnx"])
+    parser.add_argument("--max-batch", type=int, default=64, help="max items merged into one forward pass")
+    parser.add_argument("--max-wait-ms", type=float, default=5, help="how long to wait for more requests")
+    args = parser.parse_args()
+
+    backend = make_backend(args.backend, "clip-ViT-B-32", "all-MiniLM-L6-v2")
+    EmbeddingServer(backend, args.address, max_batch_items=args.max_batch, max_wait_ms=args.max_wait_ms).serve_forever()
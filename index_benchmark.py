@@ -0,0 +1,134 @@
+# index_benchmark.py
+"""
+Recall@k / latency benchmark of the FAISS index types MLModel supports (INDEX_TYPE),
+measured against the exact IndexFlatIP on our own stored embeddings.
+
+    python index_benchmark.py                          # logo embeddings, all categories
+    python index_benchmark.py --kind text --category MYIPO
+    python index_benchmark.py --synthetic 200000       # random unit vectors, no DB needed
+
+A held-out sample of stored vectors is used as queries (they are not indexed), so the
+numbers reflect "new logo vs. existing corpus" searches. Pick the cheapest setting whose
+recall@10 is acceptable for the corpus size, then set INDEX_TYPE and the INDEX_* knobs.
+"""
+
+import argparse
+import json
+import time
+
+import faiss
+import numpy as np
+
+from ml_utils import IMAGE_DIM, TEXT_DIM, build_ip_index, index_type_of, valid_rows
+
+# (label, overrides on top of the defaults in ml_utils.index_params_from_env)
+DEFAULT_CONFIGS = [
+    ("flat",                   {'type': 'flat'}),
+    ("hnsw M=16 ef=32",        {'type': 'hnsw', 'hnsw_m': 16, 'ef_search': 32}),
+    ("hnsw M=32 ef=64",        {'type': 'hnsw', 'hnsw_m': 32, 'ef_search': 64}),
+    ("hnsw M=32 ef=128",       {'type': 'hnsw', 'hnsw_m': 32, 'ef_search': 128}),
+    ("ivf_flat nprobe=4",      {'type': 'ivf_flat', 'nprobe': 4}),
+    ("ivf_flat nprobe=16",     {'type': 'ivf_flat', 'nprobe': 16}),
+    ("ivf_flat nprobe=64",     {'type': 'ivf_flat', 'nprobe': 64}),
+    ("ivf_pq nprobe=16",       {'type': 'ivf_pq', 'nprobe': 16}),
+    ("ivf_pq nprobe=64",       {'type': 'ivf_pq', 'nprobe': 64}),
+]
+
+BASE_PARAMS = {'type': 'flat', 'hnsw_m': 32, 'ef_construction': 80, 'ef_search': 64,
+               'nlist': 0, 'nprobe': 16, 'pq_m': 0, 'pq_bits': 8}
+
+
+def load_vectors(kind, category=None, synthetic=0, seed=0):
+    """Returns a normalized float32 matrix of stored (or synthetic) embeddings."""
+    dim = IMAGE_DIM if kind == 'logo' else TEXT_DIM
+    if synthetic:
+        vectors = np.random.default_rng(seed).standard_normal((synthetic, dim)).astype(np.float32)
+    else:
+        import database as db
+        data = db.get_all_embeddings(category=category)
+        vectors, _ = valid_rows(data, kind)
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def recall_at_k(found, truth, k):
+    hits = sum(len(set(f[:k]) & set(t[:k]) - {-1}) for f, t in zip(found, truth))
+    return hits / float(len(truth) * k)
+
+
+def _index_bytes(index):
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def run_benchmark(vectors, configs=None, queries=200, k=10, seed=0):
+    """Benchmarks each config; queries are held out from the indexed corpus."""
+    configs = configs or DEFAULT_CONFIGS
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(vectors))
+    n_q = min(queries, max(1, len(vectors) // 10))
+    query, corpus = vectors[order[:n_q]], vectors[order[n_q:]]
+    ids = np.arange(len(corpus), dtype='int64')
+    dim = vectors.shape[1]
+
+    exact = faiss.IndexFlatIP(dim)
+    exact.add(corpus)
+    _, truth = exact.search(query, k)
+
+    results = []
+    for label, overrides in configs:
+        params = dict(BASE_PARAMS, **overrides)
+        start = time.perf_counter()
+        index = build_ip_index(corpus, ids, dim, params)
+        build_s = time.perf_counter() - start
+
+        # Batched throughput, then one query at a time like /api/image_search
+        start = time.perf_counter()
+        _, found = index.search(query, k)
+        batch_s = time.perf_counter() - start
+        latencies = []
+        for q in query:
+            t0 = time.perf_counter()
+            index.search(q[None, :], k)
+            latencies.append((time.perf_counter() - t0) * 1000.0)
+
+        results.append({
+            'config':       label,
+            'built_as':     index_type_of(index),
+            'recall_at_k':  round(recall_at_k(found, truth, k), 4),
+            'p50_ms':       round(float(np.percentile(latencies, 50)), 3),
+            'p99_ms':       round(float(np.percentile(latencies, 99)), 3),
+            'qps_batched':  round(n_q / batch_s, 1) if batch_s else None,
+            'build_s':      round(build_s, 2),
+            'index_mb':     round(_index_bytes(index) / 1e6, 2),
+        })
+    return {'corpus': len(corpus), 'queries': n_q, 'dim': dim, 'k': k, 'results': results}
+
+
+def print_report(report):
+    print(f"--- corpus={report['corpus']} queries={report['queries']} dim={report['dim']} "
+          f"(recall@{report['k']} vs exact IndexFlatIP) ---")
+    print(f"{'config':<22}{'built as':<10}{'recall':>8}{'p50 ms':>9}{'p99 ms':>9}{'qps':>10}{'build s':>9}{'MB':>9}")
+    for r in report['results']:
+        print(f"{r['config']:<22}{r['built_as']:<10}{r['recall_at_k']:>8.4f}{r['p50_ms']:>9.3f}"
+              f"{r['p99_ms']:>9.3f}{r['qps_batched']:>10}{r['build_s']:>9.2f}{r['index_mb']:>9.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare FAISS index types on MarkLogic embeddings.")
+    parser.add_argument("--kind", choices=["logo", "text"], default="logo")
+    parser.add_argument("--category", default=None, help="restrict to one trademark category (e.g. MYIPO)")
+    parser.add_argument("--synthetic", type=int, default=0, help="use N random vectors instead of the DB")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--json", action="store_true", help="print the raw report as JSON")
+    args = parser.parse_args()
+
+    vectors = load_vectors(args.kind, args.category, args.synthetic)
+    if len(vectors) < 2:
+        raise SystemExit("Not enough embeddings to benchmark.")
+    report = run_benchmark(vectors, queries=args.queries, k=args.k)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
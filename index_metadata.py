@@ -0,0 +1,117 @@
+# index_metadata.py
+"""
+In-memory category / Nice class / batch postings for the ids in the FAISS indexes.
+
+Filtered vector search turns a filter into an id array here and hands it to FAISS as
+an IDSelector, so only matching marks compete for the top-k (instead of filtering the
+global top 10 afterwards in SQL, which often left nothing).
+"""
+
+import re
+import threading
+from collections import defaultdict
+
+import numpy as np
+
+
+def parse_classes(value):
+    """'25', '9, 35', 'Class 25 & 35' or [25, 35] -> sorted list of class numbers."""
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple, set)):
+        candidates = value
+    else:
+        candidates = re.findall(r'\d+', str(value))
+    return sorted({int(c) for c in candidates})
+
+
+def nice_classes(value):
+    """parse_classes limited to plausible Nice classes (1..99), as stored in trademarks.class_numbers."""
+    return [c for c in parse_classes(value) if 1 <= c <= 99]
+
+
+class IndexMetadata:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows = {}                         # id -> (category, classes tuple, (batch_number, batch_year))
+        self._by_category = defaultdict(set)
+        self._by_class    = defaultdict(set)
+        self._by_batch    = defaultdict(set)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _add(self, tm_id, category, classes, batch):
+        self._rows[tm_id] = (category, classes, batch)
+        self._by_category[category].add(tm_id)
+        for c in classes:
+            self._by_class[c].add(tm_id)
+        self._by_batch[batch].add(tm_id)
+
+    def _discard(self, tm_id):
+        row = self._rows.pop(tm_id, None)
+        if row is None:
+            return
+        category, classes, batch = row
+        self._by_category[category].discard(tm_id)
+        for c in classes:
+            self._by_class[c].discard(tm_id)
+        self._by_batch[batch].discard(tm_id)
+
+    @staticmethod
+    def _normalize(meta):
+        category = (meta.get('category') or '').upper() or None
+        batch = (str(meta.get('batch_number') or '') or None, str(meta.get('batch_year') or '') or None)
+        # Same normalization as the SQL class_numbers column, so FAISS and SQL filters agree
+        return category, tuple(nice_classes(meta.get('class_indices'))), batch
+
+    def load(self, rows):
+        """rows: iterable of dicts with id, category, class_indices, batch_number, batch_year."""
+        with self._lock:
+            self._rows.clear()
+            self._by_category.clear()
+            self._by_class.clear()
+            self._by_batch.clear()
+            for meta in rows:
+                self._add(meta['id'], *self._normalize(meta))
+
+    def upsert(self, meta_by_id):
+        with self._lock:
+            for tm_id, meta in meta_by_id.items():
+                self._discard(tm_id)
+                self._add(tm_id, *self._normalize(meta))
+
+    def remove(self, ids):
+        with self._lock:
+            for tm_id in ids:
+                self._discard(tm_id)
+
+    def select(self, category=None, classes=None, batch_number=None, batch_year=None):
+        """
+        Ids matching every given filter (classes match if the mark has ANY of them).
+        Returns None when no filter is set, i.e. "search everything".
+        """
+        if not (category or (classes and str(classes).strip()) or batch_number or batch_year):
+            return None
+        with self._lock:
+            sets = []
+            if category:
+                sets.append(self._by_category.get(category.upper(), set()))
+            if classes and str(classes).strip():
+                classes = nice_classes(classes)
+                sets.append(set().union(*(self._by_class.get(c, set()) for c in classes)))
+            if batch_number or batch_year:
+                sets.append({i for (num, year), ids in self._by_batch.items()
+                             if (not batch_number or num == str(batch_number))
+                             and (not batch_year or year == str(batch_year))
+                             for i in ids})
+            sets.sort(key=len)
+            if not sets[0]:
+                return np.zeros(0, dtype='int64')
+            allowed = set(sets[0]).intersection(*sets[1:])
+        return np.fromiter(allowed, dtype='int64', count=len(allowed))
+
+    def stats(self):
+        with self._lock:
+            return {'ids': len(self._rows), 'categories': len(self._by_category),
+                    'classes': len(self._by_class), 'batches': len(self._by_batch)}
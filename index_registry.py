@@ -0,0 +1,118 @@
+# index_registry.py
+"""
+Process-wide cache of per-target FAISS indexes used by /api/perform_comparison.
+
+Each target (MYIPO, CLIENT or any other trademark category) gets a logo and a text
+IndexIDMap built once from the DB and reused until a write to that target
+invalidates it. The next request rebuilds it; concurrent requests for the same
+target wait for one build instead of each running their own.
+"""
+
+import threading
+import time
+
+
+import database as db
+from ml_utils import IMAGE_DIM, TEXT_DIM, build_ip_index, index_params_from_env, valid_rows
+
+CLIENT_TARGET = 'CLIENT'
+
+
+class TargetIndexes:
+    """Prebuilt indexes for one target. Searches return DB ids directly (-1 = no hit)."""
+
+    def __init__(self, target, logo_index, text_index, build_seconds):
+        self.target        = target
+        self.logo_index    = logo_index
+        self.text_index    = text_index
+        self.build_seconds = build_seconds
+        self.built_at      = time.time()
+        self.hits          = 0
+
+    @property
+    def size(self):
+        return max(self.logo_index.ntotal, self.text_index.ntotal)
+
+    def stats(self):
+        return {
+            'logos':         int(self.logo_index.ntotal),
+            'texts':         int(self.text_index.ntotal),
+            'build_seconds': self.build_seconds,
+            'age_seconds':   round(time.time() - self.built_at, 1),
+            'hits':          self.hits,
+        }
+
+
+class TargetIndexRegistry:
+    def __init__(self, index_params=None):
+        self.index_params = index_params or index_params_from_env()   # same INDEX_TYPE as MLModel
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._build_locks = {}
+        self._generations = {}   # target -> invalidation count, to detect writes during a build
+        self.counters = {'hits': 0, 'builds': 0, 'invalidations': 0}
+
+    def _load(self, target):
+        if target == CLIENT_TARGET:
+            return db.get_all_client_embeddings()
+        return db.get_all_embeddings(category=target)
+
+    def _build(self, target):
+        start = time.perf_counter()
+        db_data = self._load(target)
+        logo_index = build_ip_index(*valid_rows(db_data, 'logo'), IMAGE_DIM, self.index_params)
+        text_index = build_ip_index(*valid_rows(db_data, 'text'), TEXT_DIM, self.index_params)
+        entry = TargetIndexes(target, logo_index, text_index, round(time.perf_counter() - start, 3))
+        print(f"[IndexRegistry] Built {target} indexes in {entry.build_seconds}s: "
+              f"{logo_index.ntotal} logos, {text_index.ntotal} texts.")
+        return entry
+
+    def get(self, target):
+        """Returns the cached TargetIndexes for target, building them on first use / after invalidation."""
+        with self._lock:
+            entry = self._entries.get(target)
+            if entry is not None:
+                entry.hits += 1
+                self.counters['hits'] += 1
+                return entry
+            build_lock = self._build_locks.setdefault(target, threading.Lock())
+
+        with build_lock:
+            with self._lock:
+                entry = self._entries.get(target)
+                if entry is not None:
+                    entry.hits += 1
+                    self.counters['hits'] += 1
+                    return entry
+                generation = (self._generations.get(target), self._generations.get(None))
+            entry = self._build(target)
+            with self._lock:
+                self.counters['builds'] += 1
+                # A write that landed during the build means the entry is already stale: use it once, don't cache it
+                if (self._generations.get(target), self._generations.get(None)) == generation:
+                    self._entries[target] = entry
+            return entry
+
+    def invalidate(self, target=None):
+        """Drops one target's indexes (or all of them when target is None)."""
+        with self._lock:
+            self.counters['invalidations'] += 1
+            self._generations[target] = self._generations.get(target, 0) + 1
+            if target is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(target, None)
+
+    def on_db_write(self, table, upserted=(), deleted=(), category=None, vectors=None, metadata=None):
+        """database.py write listener."""
+        if table == 'client_trademarks':
+            self.invalidate(CLIENT_TARGET)
+        elif table == 'trademarks':
+            # Unknown category (e.g. a bare delete) -> drop every trademark target
+            self.invalidate(category.upper() if category else None)
+
+    def stats(self):
+        with self._lock:
+            s = dict(self.counters)
+            s['targets'] = {t: e.stats() for t, e in self._entries.items()}
+        return s
@@ -0,0 +1,233 @@
+# ingest_pipeline.py
+"""
+Staged journal ingestion: page extraction -> embedding batcher -> DB writer.
+
+Each stage runs in its own thread and hands work to the next one through a
+bounded queue, so PDF rendering, model inference and DB I/O overlap and the
+whole upload costs roughly as much as its slowest stage.
+"""
+
+import io
+import queue
+import threading
+import traceback
+
+import database as db
+
+_DONE = object()  # end-of-stream marker passed down the queues
+
+
+def _ink_mass(component):
+    """Inked pixels of a visual component: bbox area x ink ratio (both extractor backends agree on it)."""
+    x0, y0, x1, y1 = component['bbox']
+    return (x1 - x0) * (y1 - y0) * component.get('ink_ratio', 1.0)
+
+
+class JournalIngestPipeline:
+    def __init__(self, extractor, ml_model, record_defaults, start_page=4,
+                 embed_batch_size=32, queue_size=8):
+        self.extractor        = extractor
+        self.ml_model         = ml_model
+        self.record_defaults  = record_defaults   # category / batch_number / batch_year
+        self.start_page       = start_page
+        self.embed_batch_size = embed_batch_size
+
+        self.pages_q  = queue.Queue(maxsize=queue_size)   # extractor -> embedder (records per page)
+        self.batches_q = queue.Queue(maxsize=queue_size)  # embedder  -> writer   (embedded batches)
+        self.events_q = queue.Queue()                     # all stages -> NDJSON stream
+
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.stats = {
+            'pages_percentage': 0,
+            'current_page':     None,
+            'extraction_done':  False,
+            'found':            0,
+            'embedded':         0,
+            'inserted':         0,
+        }
+
+    # ==============================================================================
+    # QUEUE HELPERS
+    # ==============================================================================
+
+    def _put(self, q, item):
+        """Blocking put that gives up once the pipeline has been stopped."""
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.2)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _emit(self, status, **extra):
+        """Publishes a progress event with an overall percentage bounded by the slowest stage."""
+        with self.lock:
+            s = self.stats
+            found = s['found']
+            insert_pct = int((s['inserted'] / found) * 100) if found else 100
+            event = {
+                'status':     status,
+                'percentage': min(s['pages_percentage'], insert_pct),
+                'stages': {
+                    'extracting': {'percentage': s['pages_percentage'], 'current_page': s['current_page'], 'done': s['extraction_done']},
+                    'embedding':  {'current': s['embedded'], 'total': found},
+                    'inserting':  {'current': s['inserted'], 'total': found},
+                },
+            }
+        event.update(extra)
+        self.events_q.put(event)
+
+    def _fail(self, stage, e):
+        traceback.print_exc()
+        self.events_q.put({'status': 'error', 'message': f"{stage} failed: {e}"})
+        self.stop.set()
+
+    # ==============================================================================
+    # STAGES
+    # ==============================================================================
+
+    def _extract_stage(self, pdf_bytes):
+        try:
+            for update in self.extractor.extract_pages(io.BytesIO(pdf_bytes), start_page=self.start_page):
+                records = update.get('records', [])
+                with self.lock:
+                    self.stats['pages_percentage'] = update.get('percentage', 0)
+                    self.stats['current_page']     = update.get('current_page')
+                    self.stats['found']           += len(records)
+                self._emit('extracting', current_page=update.get('current_page'))
+                if records and not self._put(self.pages_q, records):
+                    return
+            with self.lock:
+                self.stats['pages_percentage'] = 100
+                self.stats['extraction_done']  = True
+        except Exception as e:
+            self._fail('Extraction', e)
+        finally:
+            self._put(self.pages_q, _DONE)
+
+    def _embed_batch(self, batch):
+        texts = [f"{tm.get('trademark_name','')} {tm.get('description','')}".strip() for tm in batch]
+        text_embs, text_ok = self.ml_model.generate_text_embeddings(texts)
+        logo_embs, logo_ok = self.ml_model.generate_image_embeddings([tm.get('logo_data') for tm in batch])
+
+        for i, tm in enumerate(batch):
+            if tm.get("block_snapshot") and not tm.get("evidence_snapshot"):
+                tm["evidence_snapshot"] = tm["block_snapshot"]
+            tm.update(self.record_defaults)
+            tm['text_embedding'] = text_embs[i] if text_ok[i] else None
+            tm['logo_embedding'] = logo_embs[i] if logo_ok[i] else None
+
+        if self.ml_model.use_components:
+            self._embed_components(batch)
+
+        with self.lock:
+            self.stats['embedded'] += len(batch)
+        self._emit('embedding', current=self.stats['embedded'], total=self.stats['found'])
+        return self._put(self.batches_q, batch)
+
+    def _embed_components(self, batch):
+        """Segments each logo into visual components and embeds every crop of the batch in one call."""
+        crops, owners = [], []
+        for tm in batch:
+            tm['logo_components'] = []
+            if not tm.get('logo_data'):
+                continue
+            # get_visual_components puts dense ink first, so on text-heavy logos the single letters
+            # outrank the device mark; keep the components with the most ink instead
+            components = sorted(self.extractor.get_visual_components(tm['logo_data']),
+                                key=_ink_mass, reverse=True)[:self.ml_model.max_components]
+            # A single component is the whole logo, which the main logo index already covers
+            if len(components) < 2:
+                continue
+            for no, comp in enumerate(components):
+                crops.append(comp['png'])
+                owners.append((tm, no, comp))
+        if not crops:
+            return
+        embs, ok = self.ml_model.generate_image_embeddings(crops)
+        for (tm, no, comp), emb, good in zip(owners, embs, ok):
+            if good:
+                tm['logo_components'].append({'component_no': no, 'bbox': comp['bbox'], 'area': comp['area'],
+                                              'ink_ratio': comp['ink_ratio'], 'embedding': emb})
+
+    def _embed_stage(self):
+        pending = []
+        try:
+            while True:
+                records = self._get(self.pages_q)
+                if records is _DONE:
+                    break
+                pending.extend(records)
+                while len(pending) >= self.embed_batch_size:
+                    batch, pending = pending[:self.embed_batch_size], pending[self.embed_batch_size:]
+                    if not self._embed_batch(batch):
+                        return
+            if pending and not self.stop.is_set():
+                self._embed_batch(pending)
+        except Exception as e:
+            self._fail('Embedding', e)
+        finally:
+            self._put(self.batches_q, _DONE)
+
+    def _write_stage(self):
+        try:
+            while True:
+                batch = self._get(self.batches_q)
+                if batch is _DONE:
+                    break
+                # One transaction per batch instead of a round-trip + commit per record
+                results = db.insert_trademarks_bulk(batch)
+                # Every written mark gets its components replaced, even with none: a re-uploaded serial
+                # whose new logo has 0-1 components must not keep the old logo's components
+                components = {r['id']: tm['logo_components'] for tm, r in zip(batch, results)
+                              if r['id'] and 'logo_components' in tm}
+                if components:
+                    db.replace_logo_components_bulk(components)
+                with self.lock:
+                    self.stats['inserted'] += sum(1 for r in results if r['id'])
+                self._emit('inserting', current=self.stats['inserted'], total=self.stats['found'])
+        except Exception as e:
+            self._fail('DB write', e)
+        finally:
+            self.events_q.put(_DONE)
+
+    # ==============================================================================
+    # DRIVER
+    # ==============================================================================
+
+    def run(self, pdf_bytes):
+        """
+        Starts all stages and yields progress events until the writer finishes.
+        Returns the number of inserted records via the final 'finished' event.
+        """
+        threads = [
+            threading.Thread(target=self._extract_stage, args=(pdf_bytes,), daemon=True, name="ingest-extract"),
+            threading.Thread(target=self._embed_stage, daemon=True, name="ingest-embed"),
+            threading.Thread(target=self._write_stage, daemon=True, name="ingest-write"),
+        ]
+        for t in threads:
+            t.start()
+
+        try:
+            while True:
+                event = self.events_q.get()
+                if event is _DONE:
+                    break
+                yield event
+        finally:
+            # Client disconnects close the generator; unblock the stages so the threads exit
+            self.stop.set()
+
+        for t in threads:
+            t.join(timeout=5)
+        yield {'status': 'finished', 'inserted': self.stats['inserted'], 'found': self.stats['found']}
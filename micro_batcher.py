@@ -0,0 +1,114 @@
+# micro_batcher.py
+"""
+Request micro-batching: concurrent callers submit small encode jobs, a single
+worker thread merges whatever arrives within a few milliseconds (or up to
+max_batch_items) into one forward pass and hands each caller its own rows.
+"""
+
+import queue
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+
+class _Job:
+    __slots__ = ("items", "submitted", "done", "result", "error")
+
+    def __init__(self, items):
+        self.items = items
+        self.submitted = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    return float(np.percentile(np.asarray(values), pct))
+
+
+class MicroBatcher:
+    def __init__(self, encode_fn, max_batch_items=64, max_wait_ms=5, name="batcher"):
+        self.encode_fn = encode_fn              # list of items -> (n, dim) array
+        self.max_batch_items = max_batch_items
+        self.max_wait = max_wait_ms / 1000.0
+        self.name = name
+
+        self._jobs = queue.Queue()
+        self._lock = threading.Lock()
+        self._batch_sizes = deque(maxlen=1024)  # recent items per forward pass
+        self._waits_ms = deque(maxlen=1024)     # recent submit -> batch-start delays
+        self.counters = {"requests": 0, "items": 0, "batches": 0, "errors": 0, "max_batch": 0}
+
+        self._worker = threading.Thread(target=self._run, daemon=True, name=f"micro-{name}")
+        self._worker.start()
+
+    def submit(self, items):
+        """Blocks until the batch containing these items has been encoded; returns their rows."""
+        if not items:
+            return np.zeros((0, 0), dtype=np.float32)
+        job = _Job(list(items))
+        with self._lock:
+            self.counters["requests"] += 1
+        self._jobs.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _collect(self):
+        jobs = [self._jobs.get()]
+        total = len(jobs[0].items)
+        deadline = time.monotonic() + self.max_wait
+        while total < self.max_batch_items:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                job = self._jobs.get(timeout=remaining)
+            except queue.Empty:
+                break
+            jobs.append(job)
+            total += len(job.items)
+        return jobs
+
+    def _run(self):
+        while True:
+            jobs = self._collect()
+            started = time.perf_counter()
+            items = [item for j in jobs for item in j.items]
+            try:
+                out = np.asarray(self.encode_fn(items), dtype=np.float32)
+                offset = 0
+                for j in jobs:
+                    j.result = out[offset:offset + len(j.items)]
+                    offset += len(j.items)
+            except Exception as e:
+                for j in jobs:
+                    j.error = e
+                with self._lock:
+                    self.counters["errors"] += 1
+
+            with self._lock:
+                self.counters["batches"] += 1
+                self.counters["items"] += len(items)
+                self.counters["max_batch"] = max(self.counters["max_batch"], len(items))
+                self._batch_sizes.append(len(items))
+                self._waits_ms.extend((started - j.submitted) * 1000.0 for j in jobs)
+            for j in jobs:
+                j.done.set()
+
+    def stats(self):
+        with self._lock:
+            s = dict(self.counters)
+            sizes, waits = list(self._batch_sizes), list(self._waits_ms)
+        s["queue_depth"]   = self._jobs.qsize()
+        s["avg_batch"]     = round(s["items"] / s["batches"], 2) if s["batches"] else 0.0
+        s["p50_batch"]     = _percentile(sizes, 50)
+        s["p99_wait_ms"]   = round(_percentile(waits, 99), 3)
+        s["max_wait_ms"]   = self.max_wait * 1000.0
+        s["max_batch_items"] = self.max_batch_items
+        return s
@@ -1,113 +1,995 @@
-from sentence_transformers import SentenceTransformer
+import io
+import json
+import os
+import threading
+import time
 import faiss
 import numpy as np
 from PIL import Image
 import database as db
+from embedding_cache import EmbeddingCache, normalize_text
+from micro_batcher import MicroBatcher
+from index_metadata import IndexMetadata
+from rw_lock import ReadWriteLock
 
-class MLModel:
-    def __init__(self, image_model_name='clip-ViT-B-32', text_model_name='all-MiniLM-L6-v2'):
-        print("Loading ML models...")
+IMAGE_DIM = 512
+TEXT_DIM  = 384
+
+# Logo components are indexed as trademark_id * COMPONENT_SLOTS + component_no
+COMPONENT_SLOTS = 64
+
+def component_id(trademark_id, component_no):
+    return int(trademark_id) * COMPONENT_SLOTS + int(component_no)
+
+def component_ids_of(trademark_ids):
+    """Every possible component id of the given marks (for remove_ids / filter selectors)."""
+    marks = np.asarray(list(trademark_ids), dtype='int64')
+    return (marks[:, None] * COMPONENT_SLOTS + np.arange(COMPONENT_SLOTS, dtype='int64')).ravel()
+
+def _image_payload(item):
+    """Returns the bytes that identify an image for caching (bytes, stream contents or PIL pixels)."""
+    if isinstance(item, Image.Image):
+        return f"{item.mode}:{item.size}".encode() + item.tobytes()
+    if isinstance(item, (bytes, bytearray, memoryview)):
+        return bytes(item)
+    return item.read()
+
+def _open_image(item):
+    """Opens raw bytes, a file stream or a PIL image as an RGB image."""
+    if isinstance(item, Image.Image):
+        return item.convert("RGB")
+    if isinstance(item, (bytes, bytearray, memoryview)):
+        item = io.BytesIO(bytes(item))
+    return Image.open(item).convert("RGB")
+
+INDEX_TYPES = ('flat', 'hnsw', 'ivf_flat', 'ivf_pq')
+
+def index_params_from_env():
+    """Index type and tuning knobs (INDEX_TYPE=flat|hnsw|ivf_flat|ivf_pq plus INDEX_* overrides)."""
+    params = {
+        'type':            os.getenv('INDEX_TYPE', 'flat').lower(),
+        'hnsw_m':          int(os.getenv('INDEX_HNSW_M', 32)),
+        'ef_construction': int(os.getenv('INDEX_HNSW_EF_CONSTRUCTION', 80)),
+        'ef_search':       int(os.getenv('INDEX_HNSW_EF_SEARCH', 64)),
+        'nlist':           int(os.getenv('INDEX_IVF_NLIST', 0)),    # 0 = ~4*sqrt(n)
+        'nprobe':          int(os.getenv('INDEX_IVF_NPROBE', 16)),
+        'pq_m':            int(os.getenv('INDEX_PQ_M', 0)),         # 0 = dim / 8 sub-quantizers
+        'pq_bits':         int(os.getenv('INDEX_PQ_BITS', 8)),
+    }
+    if params['type'] not in INDEX_TYPES:
+        raise ValueError(f"Unsupported INDEX_TYPE '{params['type']}' (expected one of {INDEX_TYPES})")
+    return params
+
+def _make_inner_index(n, dim, params):
+    """Creates the (untrained) inner index; falls back to Flat when the corpus is too small to train on."""
+    kind = params['type']
+    if kind == 'hnsw':
+        index = faiss.IndexHNSWFlat(dim, params['hnsw_m'], faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = params['ef_construction']
+        return index, kind
+    if kind in ('ivf_flat', 'ivf_pq'):
+        nlist = params['nlist'] or max(1, int(4 * np.sqrt(n)))
+        pq_m  = params['pq_m'] or dim // 8
+        min_train = max(nlist, 2 ** params['pq_bits'] if kind == 'ivf_pq' else 0)
+        if n >= min_train:
+            quantizer = faiss.IndexFlatIP(dim)
+            if kind == 'ivf_flat':
+                return faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT), kind
+            return faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, params['pq_bits'], faiss.METRIC_INNER_PRODUCT), kind
+        if n:
+            print(f"Only {n} vectors: too few to train {kind} (need {min_train}), using Flat.")
+    # Use IndexFlatIP (Inner Product) for Cosine Similarity
+    return faiss.IndexFlatIP(dim), 'flat'
+
+def apply_search_params(index, params):
+    """Sets query-time knobs (efSearch / nprobe) on an index built or loaded with build_ip_index."""
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = params['ef_search']
+    elif isinstance(inner, faiss.IndexIVF):
+        inner.nprobe = params['nprobe']
+    return index
+
+def index_supports_remove(index):
+    """HNSW graphs cannot drop vectors; everything else here supports remove_ids."""
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    return not isinstance(inner, faiss.IndexHNSW)
+
+def index_ids(index):
+    """int64 array of the database ids held by an index from build_ip_index (IDMap id_map or IVF lists)."""
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.vector_to_array(index.id_map)
+    invlists = index.invlists
+    parts = []
+    for lst in range(index.nlist):
+        size = invlists.list_size(lst)
+        if size:
+            ptr = invlists.get_ids(lst)
+            parts.append(faiss.rev_swig_ptr(ptr, size).copy())
+            invlists.release_ids(lst, ptr)
+    return np.concatenate(parts) if parts else np.zeros(0, dtype='int64')
+
+def valid_rows(db_data, column):
+    """(vectors, ids) of the rows of an id-aligned db.get_all_embeddings column that hold an embedding."""
+    valid = db_data[f'{column}_valid']
+    if valid.all():
+        return db_data[column], db_data['ids']   # no copy in the common case
+    return db_data[column][valid], db_data['ids'][valid]
+
+def build_ip_index(vectors, ids, dim, params=None):
+    """Cosine index over (already normalized) vectors, keyed by database id. IVF types train on `vectors`."""
+    params = params or index_params_from_env()
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    # Vectors are already normalized in generate_*_embeddings,
+    # but we run normalize_L2 here as a safety double-check.
+    if len(vectors):
+        faiss.normalize_L2(vectors)
+    inner, _ = _make_inner_index(len(vectors), dim, params)
+    if not inner.is_trained:
+        inner.train(vectors)
+    # IVF stores ids in its inverted lists and removes them natively. Wrapped in an IndexIDMap,
+    # remove_ids would compact the id map while the lists keep their old offsets, shifting every hit.
+    index = apply_search_params(inner if isinstance(inner, faiss.IndexIVF) else faiss.IndexIDMap(inner), params)
+    if len(vectors):
+        # Add vectors with actual database IDs (int64)
+        index.add_with_ids(vectors, np.asarray(ids, dtype='int64'))
+    return index
+
+def filtered_search_params(index, params, allowed, total):
+    """
+    SearchParameters restricting a search to `allowed` ids. Approximate indexes widen their
+    beam / probes by the filter's selectivity so a narrow filter does not collapse recall.
+    """
+    sel = faiss.IDSelectorBatch(allowed)
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    widen = max(1.0, total / max(len(allowed), 1))
+    if isinstance(inner, faiss.IndexHNSW):
+        search_params = faiss.SearchParametersHNSW(sel=sel, efSearch=int(min(max(total, 1), params['ef_search'] * widen)))
+    elif isinstance(inner, faiss.IndexIVF):
+        search_params = faiss.SearchParametersIVF(sel=sel, nprobe=int(min(inner.nlist, params['nprobe'] * widen)))
+    else:
+        search_params = faiss.SearchParameters(sel=sel)
+    search_params.selector_ref = sel   # the C++ struct holds a raw pointer: keep the selector alive
+    return search_params
+
+def max_search_results():
+    """Safety cap on how many hits a range search may return (SEARCH_MAX_RESULTS, default 1000)."""
+    return int(os.getenv('SEARCH_MAX_RESULTS', 1000))
+
+def range_search(index, queries, threshold, max_results=None, search_params=None):
+    """
+    Every hit with cosine similarity above `threshold`, per query, best first.
+    Returns a list of (similarities, ids) arrays, each capped at max_results.
+    """
+    max_results = max_results or max_search_results()
+    queries = np.ascontiguousarray(queries, dtype='float32')
+    empty = (np.zeros(0, dtype='float32'), np.zeros(0, dtype='int64'))
+    if index is None or index.ntotal == 0 or not len(queries):
+        return [empty] * len(queries)
+    lims, sims, ids = index.range_search(queries, float(threshold), params=search_params)
+    results = []
+    for q in range(len(queries)):
+        q_sims, q_ids = sims[lims[q]:lims[q + 1]], ids[lims[q]:lims[q + 1]]
+        order = np.argsort(-q_sims, kind='stable')[:max_results]
+        results.append((q_sims[order], q_ids[order]))
+    return results
+
+def index_type_of(index):
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(inner, faiss.IndexHNSW):
+        return 'hnsw'
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return 'ivf_pq'
+    if isinstance(inner, faiss.IndexIVF):
+        return 'ivf_flat'
+    return 'flat'
+
+def _normalize_rows(matrix):
+    """L2-normalizes every row in place, leaving all-zero rows untouched."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+# ==============================================================================
+# INFERENCE BACKENDS
+# ==============================================================================
+
+class TorchBackend:
+    """Default backend: SentenceTransformer models running under PyTorch."""
+    name = 'torch'
+
+    def __init__(self, image_model_name, text_model_name):
+        self.image_model_name = image_model_name
+        self.text_model_name  = text_model_name
+        self.image_model = None
+        self.text_model  = None
+
+    def load(self):
+        # Imported here: pulling in torch is most of the start-up cost
+        from sentence_transformers import SentenceTransformer
         # CLIP for images (512 dimensions)
-        self.image_model = SentenceTransformer(image_model_name)
+        self.image_model = SentenceTransformer(self.image_model_name)
         # MiniLM for text (384 dimensions)
-        self.text_model = SentenceTransformer(text_model_name)
+        self.text_model = SentenceTransformer(self.text_model_name)
+
+    def encode_images(self, images, batch_size):
+        return self.image_model.encode(images, batch_size=batch_size, convert_to_numpy=True, show_progress_bar=False)
+
+    def encode_texts(self, texts, batch_size):
+        return self.text_model.encode(texts, batch_size=batch_size, convert_to_numpy=True, show_progress_bar=False)
+
+def make_backend(name, image_model_name, text_model_name):
+    """Builds the inference backend named by ML_BACKEND ('torch', 'onnx' or 'remote')."""
+    name = (name or 'torch').lower()
+    if name == 'torch':
+        return TorchBackend(image_model_name, text_model_name)
+    if name == 'onnx':
+        from onnx_backend import OnnxBackend
+        return OnnxBackend(
+            model_dir=os.getenv('ONNX_MODEL_DIR', 'models/onnx'),
+            quantized=os.getenv('ONNX_QUANTIZED', 'True') == 'True'
+        )
+    if name == 'remote':
+        # Client mode: the models live in embedding_server.py, shared by all web workers
+        from embedding_server import RemoteBackend
+        return RemoteBackend()
+    raise ValueError(f"Unknown ML backend '{name}' (expected 'torch', 'onnx' or 'remote').")
+
+class IndexSnapshot:
+    """
+    Logo + text (+ optional logo-component) indexes and their id sets, published together by one
+    attribute assignment. `ids` = (logo ids, text ids, component marks) carries the sets over from the
+    previous snapshot (kept current by _apply_changes under the write lock) instead of re-reading them.
+    """
+    __slots__ = ('logo_index', 'text_index', 'id_map', 'text_id_map', 'mmapped', 'component_index', 'component_marks')
+
+    def __init__(self, logo_index, text_index, mmapped=False, component_index=None, ids=None):
+        self.logo_index  = logo_index
+        self.text_index  = text_index
+        self.mmapped     = mmapped
+        self.component_index = component_index
+        if ids is not None:
+            self.id_map, self.text_id_map, self.component_marks = ids
+            return
+        self.id_map      = set(index_ids(logo_index).tolist())
+        self.text_id_map = set(index_ids(text_index).tolist())
+        self.component_marks = set()
+        if component_index is not None:
+            self.component_marks = set((index_ids(component_index) // COMPONENT_SLOTS).tolist())
+
+class MLModel:
+    def __init__(self, image_model_name='clip-ViT-B-32', text_model_name='all-MiniLM-L6-v2', batch_size=32, cache=None, backend=None,
+                 micro_batch=None):
+        # Models are loaded lazily (first use or warm_up), so importing app.py stays cheap
+        self.image_model_name = image_model_name
+        self.text_model_name  = text_model_name
+        self.batch_size = batch_size
+        if backend is None or isinstance(backend, str):
+            backend = make_backend(backend or os.getenv('ML_BACKEND', 'torch'), image_model_name, text_model_name)
+        self.backend = backend
+        self._loaded    = False
+        self._load_lock = threading.Lock()
+
+        # Concurrent requests (e.g. several /api/image_search calls) share forward passes
+        if micro_batch is None:
+            micro_batch = os.getenv('ML_MICRO_BATCH', 'True') == 'True'
+        self.micro_batch = micro_batch
+        self._batchers = {}
+        self._batchers_lock = threading.Lock()
+
+        # Content-hash cache consulted by every embedding call (pass cache=False to disable)
+        self.cache = EmbeddingCache() if cache is None else (cache or None)
         
-        self.logo_index = None
-        self.id_map = [] 
-        print("ML models loaded successfully.")
+        # Published index snapshot (logo + text indexes and id maps), swapped atomically on rebuild
+        self._snapshot = None
+        self.index_dir = os.getenv('INDEX_DIR', 'index_cache')
+        self.index_params = index_params_from_env()
+        self.index_meta   = IndexMetadata()   # category / class / batch postings for filtered search
+        # Searches share the read side; in-place updates and snapshot swaps take the write side
+        self._index_rw = ReadWriteLock()
+        self._build_lock = threading.Lock()    # one shadow build at a time
+        self._pending_changes = None           # writes seen while a shadow build is reading the DB
+        # Optional per-component logo index for composite marks (device + wordmark)
+        self.use_components = os.getenv('LOGO_COMPONENTS', 'False') == 'True'
+        self.max_components = min(int(os.getenv('LOGO_COMPONENTS_MAX', 6)), COMPONENT_SLOTS)
+        self._check_thread = None
+        self._rebuild_thread = None
 
-    def generate_image_embedding(self, image_file_stream):
-        """Converts an image file stream into a NORMALIZED vector embedding."""
+        # Readiness bookkeeping reported by /api/ready
+        self.model_state = 'not_loaded'   # not_loaded | loading | ready | error
+        self.index_state = 'not_built'    # not_built | building | ready | empty | error
+        self.last_error  = None
+        self.load_seconds = None
+        self._warmup_thread = None
+
+    # ==============================================================================
+    # LAZY LOADING & WARM-UP
+    # ==============================================================================
+
+    def load_models(self):
+        """Loads the backend's image and text models once; safe to call from several threads."""
+        if self._loaded:
+            return
+        with self._load_lock:
+            if self._loaded:
+                return
+            self.model_state = 'loading'
+            start = time.perf_counter()
+            print(f"Loading ML models ({self.backend.name} backend)...")
+            try:
+                self.backend.load()
+            except Exception as e:
+                self.model_state = 'error'
+                self.last_error  = f"Model load failed: {e}"
+                raise
+            self._loaded = True
+            self.load_seconds = round(time.perf_counter() - start, 2)
+            self.model_state  = 'ready'
+            print(f"ML models loaded successfully in {self.load_seconds}s.")
+
+    def warm_up(self):
+        """Loads the models and builds the logo index. Errors are recorded, not raised."""
         try:
-            image = Image.open(image_file_stream).convert("RGB")
-            # Returns a list, we take the first element [0]
-            embedding = self.image_model.encode([image], convert_to_numpy=True, show_progress_bar=False)[0]
-            
-            # --- CRUCIAL FOR ACCURACY ---
-            # Normalize the vector to unit length (1.0) immediately.
-            # This fixes the "0.02%" similarity problem.
-            norm = np.linalg.norm(embedding)
-            if norm > 0:
-                embedding = embedding / norm
-                
-            return embedding.astype('float32')
+            self.load_models()
+            self.load_or_build_indexes()
+            self.start_consistency_checks()
         except Exception as e:
-            print(f"Error processing image for embedding: {e}")
+            print(f"ML warm-up failed: {e}")
+            self.last_error = str(e)
+
+    def start_warmup(self):
+        """Runs warm_up in a daemon thread so the web worker can serve requests immediately."""
+        if self._warmup_thread is None or not self._warmup_thread.is_alive():
+            self._warmup_thread = threading.Thread(target=self.warm_up, daemon=True, name="ml-warmup")
+            self._warmup_thread.start()
+        return self._warmup_thread
+
+    def is_ready(self, need_index=False):
+        if self.model_state != 'ready':
+            return False
+        return not need_index or self.index_state in ('ready', 'empty')
+
+    def status(self):
+        snapshot = self._snapshot
+        return {
+            'models':       self.model_state,
+            'index':        self.index_state,
+            'index_size':   snapshot.logo_index.ntotal if snapshot is not None else 0,
+            'text_index_size': snapshot.text_index.ntotal if snapshot is not None else 0,
+            'component_index_size': snapshot.component_index.ntotal if snapshot is not None and snapshot.component_index is not None else None,
+            'index_type':   index_type_of(snapshot.logo_index) if snapshot is not None else self.index_params['type'],
+            'rebuilding':   self._build_lock.locked(),
+            'backend':      self.backend.name,
+            'load_seconds': self.load_seconds,
+            'error':        self.last_error,
+        }
+
+    # ==============================================================================
+    # BATCHED EMBEDDINGS
+    # ==============================================================================
+
+    def _cached_encode(self, model_name, keys, encode_fn, out, valid):
+        """
+        Fills out[i] for every i with a key, from the cache where possible.
+        encode_fn(positions) must return raw embeddings for the given row positions.
+        """
+        cached = self.cache.get_many(list({k for k in keys if k is not None})) if self.cache else {}
+
+        # Encode each distinct missing key once, even if it repeats inside the batch
+        first_pos = {}
+        for i, key in enumerate(keys):
+            if key is None:
+                continue
+            if key in cached:
+                out[i] = cached[key]
+                valid[i] = True
+            elif key not in first_pos:
+                first_pos[key] = i
+
+        if first_pos:
+            positions = list(first_pos.values())
+            encoded = _normalize_rows(np.asarray(encode_fn(positions), dtype=np.float32))
+            fresh = dict(zip(first_pos.keys(), encoded))
+            for i, key in enumerate(keys):
+                if key in fresh:
+                    out[i] = fresh[key]
+                    valid[i] = True
+            if self.cache:
+                self.cache.put_many(fresh, model_name)
+        return out, valid
+
+    def _batcher(self, kind):
+        with self._batchers_lock:
+            if kind not in self._batchers:
+                encode = self.backend.encode_images if kind == 'images' else self.backend.encode_texts
+                self._batchers[kind] = MicroBatcher(
+                    lambda items: encode(items, self.batch_size),
+                    max_batch_items=int(os.getenv('ML_MICRO_BATCH_MAX_ITEMS', 64)),
+                    max_wait_ms=float(os.getenv('ML_MICRO_BATCH_WAIT_MS', 5)),
+                    name=kind
+                )
+            return self._batchers[kind]
+
+    def _encode_images(self, images):
+        self.load_models()
+        if self.micro_batch:
+            return self._batcher('images').submit(images)
+        return self.backend.encode_images(images, self.batch_size)
+
+    def _encode_texts(self, texts):
+        self.load_models()
+        if self.micro_batch:
+            return self._batcher('texts').submit(texts)
+        return self.backend.encode_texts(texts, self.batch_size)
+
+    def micro_batch_stats(self):
+        """Queue depth / batch-size / wait metrics per modality (None when disabled)."""
+        if not self.micro_batch:
             return None
+        with self._batchers_lock:
+            batchers = dict(self._batchers)
+        return {kind: b.stats() for kind, b in batchers.items()}
+
+    def generate_image_embeddings(self, items):
+        """
+        Encodes a list of images (bytes, file streams or PIL images) in batched forward passes.
+        Returns (embeddings, valid): a NORMALIZED float32 matrix of shape (n, 512) and a boolean mask.
+        Images that fail to open get a zero row and valid=False instead of aborting the batch.
+        """
+        embeddings = np.zeros((len(items), IMAGE_DIM), dtype=np.float32)
+        valid      = np.zeros(len(items), dtype=bool)
+
+        keys, images = [None] * len(items), {}
+        for i, item in enumerate(items):
+            if item is None:
+                continue
+            try:
+                payload = _image_payload(item)
+                images[i] = _open_image(item if isinstance(item, Image.Image) else payload)
+                keys[i] = EmbeddingCache.make_key(self.image_model_name, payload)
+            except Exception as e:
+                print(f"Error processing image for embedding (item {i}): {e}")
+
+        # --- CRUCIAL FOR ACCURACY ---
+        # Every vector is normalized to unit length (1.0) before it is returned or cached.
+        # This fixes the "0.02%" similarity problem.
+        encode = lambda positions: self._encode_images([images[i] for i in positions])
+        return self._cached_encode(self.image_model_name, keys, encode, embeddings, valid)
+
+    def generate_text_embeddings(self, texts):
+        """
+        Encodes a list of strings in batched forward passes.
+        Returns (embeddings, valid): a NORMALIZED float32 matrix of shape (n, 384) and a boolean mask.
+        Empty texts get a zero row and valid=False, matching generate_text_embedding.
+        """
+        embeddings = np.zeros((len(texts), TEXT_DIM), dtype=np.float32)
+        valid      = np.zeros(len(texts), dtype=bool)
+
+        clean = [normalize_text(t) for t in texts]
+        keys  = [EmbeddingCache.make_key(self.text_model_name, t) if t else None for t in clean]
+
+        # Normalize text vectors for consistent Cosine Similarity search
+        encode = lambda positions: self._encode_texts([clean[i] for i in positions])
+        return self._cached_encode(self.text_model_name, keys, encode, embeddings, valid)
+
+    # ==============================================================================
+    # SINGLE-ITEM EMBEDDINGS
+    # ==============================================================================
+
+    def generate_image_embedding(self, image_file_stream):
+        """Converts an image file stream into a NORMALIZED vector embedding."""
+        embeddings, valid = self.generate_image_embeddings([image_file_stream])
+        return embeddings[0] if valid[0] else None
 
     def generate_text_embedding(self, text):
         """Converts trademark description/name to a NORMALIZED vector (384-dim)."""
-        if not text:
-            return np.zeros(384, dtype=np.float32)
-        
-        embedding = self.text_model.encode(text, convert_to_numpy=True)
-        
-        # Normalize text vectors for consistent Cosine Similarity search
-        norm = np.linalg.norm(embedding)
-        if norm > 0:
-            embedding = embedding / norm
-            
-        return embedding.astype('float32')
+        embeddings, _ = self.generate_text_embeddings([text])
+        return embeddings[0]
+
+    # ==============================================================================
+    # FAISS INDEXES (persisted to INDEX_DIR, tagged with the dataset version)
+    # ==============================================================================
+
+    # Read-only views of the published snapshot (grab self._snapshot once for a consistent pair)
+    @property
+    def logo_index(self):
+        return self._snapshot.logo_index if self._snapshot is not None else None
+
+    @property
+    def text_index(self):
+        return self._snapshot.text_index if self._snapshot is not None else None
+
+    @property
+    def id_map(self):
+        """Set of indexed logo ids (updated in place under the write lock: copy it under a read lock to iterate)."""
+        return self._snapshot.id_map if self._snapshot is not None else set()
+
+    @property
+    def text_id_map(self):
+        return self._snapshot.text_id_map if self._snapshot is not None else set()
+
+    def _index_paths(self, name):
+        return (os.path.join(self.index_dir, f"{name}.faiss"),
+                os.path.join(self.index_dir, f"{name}.meta.json"))
+
+    def _dataset_version(self, table_name='trademarks'):
+        try:
+            return db.get_dataset_version(table_name)
+        except Exception as e:
+            print(f"Could not read dataset version: {e}")
+            return None
+
+    def _save_indexes(self, entries):
+        """
+        Persists (name, index, version) entries. Published indexes are updated in place under the
+        write lock, so each is serialized to memory under a brief read lock and the slow disk
+        writes happen with no lock held (a waiting writer would otherwise stall every search).
+        """
+        with self._index_rw.read():
+            blobs = [(name, faiss.serialize_index(index),
+                      {'version': version, 'ntotal': int(index.ntotal), 'dim': int(index.d),
+                       'index_type': self.index_params['type'], 'built_as': index_type_of(index)})
+                     for name, index, version in entries if index is not None and version is not None]
+        for name, blob, meta in blobs:
+            self._save_index(name, blob, meta)
+
+    def _save_index(self, name, blob, meta):
+        """Writes a serialized index atomically next to a meta file recording the dataset version it reflects."""
+        path, meta_path = self._index_paths(name)
+        try:
+            os.makedirs(self.index_dir, exist_ok=True)
+            blob.tofile(path + ".tmp")
+            os.replace(path + ".tmp", path)
+            with open(meta_path + ".tmp", "w") as f:
+                json.dump(dict(meta, built_at=time.time()), f)
+            os.replace(meta_path + ".tmp", meta_path)
+        except Exception as e:
+            print(f"Could not persist {name} index: {e}")
+
+    def _load_index(self, name, version):
+        """Loads a persisted index if it was built from the current dataset version and INDEX_TYPE."""
+        path, meta_path = self._index_paths(name)
+        if version is None or not (os.path.exists(path) and os.path.exists(meta_path)):
+            return None
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta.get('version') != version:
+                print(f"Persisted {name} index is stale ({meta.get('version')} != {version}).")
+                return None
+            if meta.get('index_type', 'flat') != self.index_params['type']:
+                print(f"Persisted {name} index is {meta.get('index_type', 'flat')}, INDEX_TYPE is {self.index_params['type']}.")
+                return None
+            # Flat / HNSW are memory-mapped; mmap'd IVF lists cannot be cloned for updates, so read those into RAM
+            if meta.get('built_as', 'flat') in ('flat', 'hnsw'):
+                index = faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            else:
+                index = faiss.read_index(path)
+                if isinstance(index, faiss.IndexIDMap):
+                    # Saved before IVF dropped the IDMap wrapper: its removes would shift ids
+                    print(f"Persisted {name} index is an IDMap-wrapped IVF index, rebuilding.")
+                    return None
+            return apply_search_params(index, self.index_params)
+        except Exception as e:
+            print(f"Could not load persisted {name} index: {e}")
+            return None
+
+    def _set_indexes(self, logo_index, text_index, mmapped=False, component_index=None):
+        with self._index_rw.write():
+            self._publish(IndexSnapshot(logo_index, text_index, mmapped, component_index))
+
+    def _publish(self, snapshot):
+        """Atomic pointer swap (caller holds the write lock); searches that already hold the old snapshot finish on it."""
+        self._snapshot   = snapshot
+        self.index_state = 'ready' if snapshot.logo_index.ntotal else 'empty'
+
+    def load_or_build_indexes(self):
+        """Warm start: mmap the persisted indexes when current, otherwise rebuild from the DB."""
+        version = self._dataset_version()
+        logo_index = self._load_index('logo', version)
+        text_index = self._load_index('text', version)
+        component_index = None
+        if self.use_components:
+            component_index = self._load_index('components', self._dataset_version('logo_components'))
+        if logo_index is not None and text_index is not None and (component_index is not None or not self.use_components):
+            self.index_meta.load(db.get_index_metadata())
+            self._set_indexes(logo_index, text_index, mmapped=True, component_index=component_index)
+            print(f"Loaded FAISS indexes from {self.index_dir} (dataset version {version}): "
+                  f"{logo_index.ntotal} logos, {text_index.ntotal} texts.")
+            return
+        self.build_indexes()
+
+    def build_indexes(self):
+        """
+        Fetches all embeddings from the DB and builds shadow logo / text indexes off the request
+        path; searches keep using the published snapshot until the new one is swapped in.
+        Writes that land during the build are recorded and replayed onto the shadow before the swap.
+        """
+        with self._build_lock:
+            print("Building FAISS indexes from database...")
+            if self.index_state != 'ready':
+                self.index_state = 'building'
+            with self._index_rw.write():
+                self._pending_changes = []
+            try:
+                # Read the version first: writes during the build make the saved files stale, never wrong
+                version = self._dataset_version()
+                component_version = self._dataset_version('logo_components') if self.use_components else None
+                db_data = db.get_all_embeddings()
+                metadata = db.get_index_metadata()
+
+                # Only rows that actually have a logo / text embedding are indexed
+                logo_index = build_ip_index(*valid_rows(db_data, 'logo'), IMAGE_DIM, self.index_params)
+                text_index = build_ip_index(*valid_rows(db_data, 'text'), TEXT_DIM, self.index_params)
+                component_index = self._build_component_index() if self.use_components else None
+            except Exception as e:
+                with self._index_rw.write():
+                    self._pending_changes = None
+                self.index_state = 'error' if self._snapshot is None else self.index_state
+                self.last_error  = f"Index build failed: {e}"
+                raise
+
+            with self._index_rw.write():
+                pending, self._pending_changes = self._pending_changes, None
+                shadow = IndexSnapshot(logo_index, text_index, component_index=component_index)
+                self.index_meta.load(metadata)
+                for deleted, meta, change in pending:
+                    self.index_meta.remove(deleted)
+                    self.index_meta.upsert(meta)
+                    replayed, _ = self._apply_changes(shadow, **change)
+                    if replayed is None:
+                        self._rebuild_in_background("writes during the build touched an HNSW index", after_current=True)
+                        break
+                    shadow = replayed
+                self._publish(shadow)
+
+            self._save_indexes([('logo', shadow.logo_index, version), ('text', shadow.text_index, version),
+                                ('components', shadow.component_index, component_version)])
+            if not shadow.logo_index.ntotal:
+                print("No logo embeddings found in the database to index.")
+            print(f"FAISS indexes built successfully: {shadow.logo_index.ntotal} logos, {shadow.text_index.ntotal} texts"
+                  f" ({len(pending)} writes replayed).")
 
     def build_logo_index(self):
-        """Fetches all logo embeddings from the DB and builds a FAISS index."""
-        print("Building FAISS logo index from database...")
-        db_data = db.get_all_embeddings()
+        """Kept for existing callers: rebuilds (and persists) both indexes."""
+        self.build_indexes()
 
-        valid_logo_entries = []
-        temp_id_map = []
-        
-        for db_id, logo_emb_array in zip(db_data['ids'], db_data['logo']):
-            # Ensure we only index non-zero/valid embeddings
-            if logo_emb_array is not None and np.any(logo_emb_array):
-                valid_logo_entries.append(logo_emb_array)
-                temp_id_map.append(db_id)
-
-        if not valid_logo_entries:
-            print("No logo embeddings found in the database to index.")
+    def _build_component_index(self):
+        data = db.get_all_component_embeddings()
+        ids = [component_id(tm_id, no) for tm_id, no in data['keys']]
+        return build_ip_index(data['embeddings'], ids, IMAGE_DIM, self.index_params)
+
+    # ==============================================================================
+    # INCREMENTAL INDEX MAINTENANCE
+    # ==============================================================================
+
+    def _rebuild_in_background(self, reason, after_current=False):
+        """Full rebuild for changes an index cannot apply in place (HNSW cannot remove vectors)."""
+        if not after_current and self._rebuild_thread is not None and self._rebuild_thread.is_alive():
             return
+        print(f"Scheduling FAISS rebuild: {reason}")
+        def rebuild():
+            try:
+                self.build_indexes()
+            except Exception as e:
+                print(f"Background FAISS rebuild failed: {e}")
+        self._rebuild_thread = threading.Thread(target=rebuild, daemon=True, name="index-rebuild")
+        self._rebuild_thread.start()
 
-        self.id_map = temp_id_map
-        logo_embeddings_np = np.vstack(valid_logo_entries).astype('float32')
+    @staticmethod
+    def _needs_rebuild(snapshot, remove_logo, remove_text, remove_components=()):
+        # Walks the batch, never the corpus: the snapshot's id sets answer membership
+        return bool((not index_supports_remove(snapshot.logo_index) and any(i in snapshot.id_map for i in remove_logo)) or
+                    (not index_supports_remove(snapshot.text_index) and any(i in snapshot.text_id_map for i in remove_text)) or
+                    (snapshot.component_index is not None and not index_supports_remove(snapshot.component_index)
+                     and any(i in snapshot.component_marks for i in remove_components)))
 
-        # Vectors are already normalized in generate_image_embedding, 
-        # but we run normalize_L2 here as a safety double-check.
-        faiss.normalize_L2(logo_embeddings_np)
-        
-        dimension = logo_embeddings_np.shape[1]
-        
-        # Use IndexFlatIP (Inner Product) for Cosine Similarity
-        cpu_index = faiss.IndexFlatIP(dimension)
-        self.logo_index = faiss.IndexIDMap(cpu_index)
-        
-        # Add vectors with actual database IDs (int64)
-        self.logo_index.add_with_ids(logo_embeddings_np, np.array(self.id_map).astype('int64'))
-        print(f"FAISS logo index built successfully with {self.logo_index.ntotal} vectors.")
+    def _apply_to_index(self, index, present, remove, vectors):
+        """
+        Removes `remove` ids that are present, then adds the non-zero `vectors` ({id: vec}),
+        keeping the `present` id set in step. Cost scales with the batch.
+        """
+        stale = [i for i in remove if i in present]
+        if stale:
+            index.remove_ids(np.asarray(stale, dtype='int64'))
+            present.difference_update(stale)
+        add_ids = [i for i, v in vectors.items() if v is not None and np.any(v)]
+        if add_ids:
+            matrix = np.asarray([vectors[i] for i in add_ids], dtype=np.float32)
+            faiss.normalize_L2(matrix)
+            index.add_with_ids(matrix, np.asarray(add_ids, dtype='int64'))
+            present.update(add_ids)
+        return len(stale), len(add_ids)
 
-    def search_logo_index(self, query_embedding, return_distances=False):
+    def _apply_changes(self, snapshot, remove, vectors, remove_text=None, remove_components=(), component_vectors=None):
         """
-        Searches the FAISS index. 
-        Returns high similarity scores (0.90+) for similar images like G813/G814.
+        Applies one batch of writes to a snapshot (caller holds the write lock). Returns the
+        snapshot to publish plus (logo +/-, text +/-) counts, or (None, None) if HNSW must rebuild.
+        remove_components drops every component of those marks; component_vectors is {(mark, no): vec}.
+        """
+        remove_text = remove if remove_text is None else remove_text
+        if self._needs_rebuild(snapshot, remove, remove_text, remove_components):
+            return None, None
+        logo_index, text_index, component_index = snapshot.logo_index, snapshot.text_index, snapshot.component_index
+        if snapshot.mmapped:
+            # mmap'd indexes are read-only views of the files on disk: copy them into RAM first
+            logo_index, text_index = faiss.clone_index(logo_index), faiss.clone_index(text_index)
+            if component_index is not None:
+                component_index = faiss.clone_index(component_index)
+        # The id sets travel with the indexes into the new snapshot and are patched in place
+        logo_ids, text_ids, marks_present = snapshot.id_map, snapshot.text_id_map, snapshot.component_marks
+        logo_rm, logo_add = self._apply_to_index(logo_index, logo_ids, remove, vectors.get('logo', {}))
+        text_rm, text_add = self._apply_to_index(text_index, text_ids, remove_text, vectors.get('text', {}))
+        if component_index is not None:
+            marks = [m for m in remove_components if m in marks_present]
+            if marks:
+                component_index.remove_ids(component_ids_of(marks))
+                marks_present.difference_update(marks)
+            added = set()
+            self._apply_to_index(component_index, added, (), {component_id(tm_id, no): vec
+                                                              for (tm_id, no), vec in (component_vectors or {}).items()})
+            marks_present.update(i // COMPONENT_SLOTS for i in added)
+        return (IndexSnapshot(logo_index, text_index, component_index=component_index,
+                              ids=(logo_ids, text_ids, marks_present)),
+                (logo_add, logo_rm, text_add, text_rm))
+
+    def apply_db_changes(self, table, upserted=(), deleted=(), category=None, vectors=None, metadata=None):
+        """
+        database.py write listener: keeps the logo / text indexes in step with trademark writes.
+        Upserted ids are removed first (an upsert can overwrite an existing serial) and re-added
+        with their new vectors; deleted ids are removed. Cost scales with the batch, not the corpus.
+        """
+        changed = set(upserted) | set(deleted)
+        if not changed:
+            return
+        if vectors is None and upserted:
+            # Written by another worker (database.listen_for_changes): load what it wrote
+            vectors, metadata = self._load_written_rows(table, upserted)
+        vectors = vectors or {}
+        if table == 'trademarks':
+            # Components of a deleted mark go with it (ON DELETE CASCADE)
+            change = {'remove': changed, 'vectors': vectors, 'remove_components': set(deleted)}
+        elif table == 'logo_components' and self.use_components:
+            # Components are always written as "replace all components of these marks"
+            change = {'remove': set(), 'vectors': {}, 'remove_components': changed,
+                      'component_vectors': vectors.get('components', {})}
+            deleted, metadata = (), None
+        else:
+            return
+        with self._index_rw.write():
+            self.index_meta.remove(deleted)
+            self.index_meta.upsert(metadata or {})
+            if self._pending_changes is not None:
+                # A rebuild is reading the DB right now; it replays this onto its shadow index
+                self._pending_changes.append((list(deleted), metadata or {}, change))
+            if self._snapshot is None:
+                return
+            snapshot, counts = self._apply_changes(self._snapshot, **change)
+            if snapshot is None:
+                return self._rebuild_in_background(f"{len(changed)} overwritten/deleted ids in an HNSW index")
+            self._publish(snapshot)
+        logo_add, logo_rm, text_add, text_rm = counts
+        if logo_rm or logo_add or text_rm or text_add:
+            print(f"FAISS indexes updated: logos +{logo_add}/-{logo_rm}, texts +{text_add}/-{text_rm}.")
+
+    def _load_written_rows(self, table, ids):
+        """Vectors + filter metadata of rows another process wrote, shaped like a local listener call."""
+        if table == 'logo_components':
+            if not self.use_components:
+                return None, None
+            data = db.get_all_component_embeddings(ids)
+            return {'components': dict(zip(data['keys'], data['embeddings']))}, None
+        if table != 'trademarks':
+            return None, None
+        data = db.get_embeddings_by_ids(ids)
+        vectors = {
+            'logo': dict(zip(*valid_rows(data, 'logo')[::-1])),
+            'text': dict(zip(*valid_rows(data, 'text')[::-1])),
+        }
+        return vectors, {row['id']: dict(row) for row in db.get_index_metadata(ids)}
+
+    def check_index_consistency(self):
+        """
+        Diffs the indexed ids against the database and repairs drift (missed listener calls,
+        writes from other processes). Persists the indexes when the dataset did not move meanwhile.
         """
-        if self.logo_index is None or self.logo_index.ntotal == 0:
-            print("Error: FAISS logo index is not built.")
-            return ([], []) if return_distances else []
+        snapshot = self._snapshot
+        if snapshot is None:
+            return None
+        version  = self._dataset_version()
+        component_version = self._dataset_version('logo_components') if snapshot.component_index is not None else None
+        expected = db.get_index_ids()
+        metadata = db.get_index_metadata()
+        with self._index_rw.read():
+            # The sets are patched in place by writers: copy them while none can run
+            have_logo, have_text = set(snapshot.id_map), set(snapshot.text_id_map)
+        missing = (expected['logo'] - have_logo) | (expected['text'] - have_text)
+        extra_logo = have_logo - expected['logo']
+        extra_text = have_text - expected['text']
+
+        logo_vecs, text_vecs = {}, {}
+        if missing:
+            fetched = db.get_embeddings_by_ids(sorted(missing))
+            logo_vecs = {i: vec for vec, i in zip(*valid_rows(fetched, 'logo')) if i in expected['logo'] - have_logo}
+            text_vecs = {i: vec for vec, i in zip(*valid_rows(fetched, 'text')) if i in expected['text'] - have_text}
+
+        with self._index_rw.write():
+            if self._snapshot is not snapshot:
+                # A listener update or rebuild landed meanwhile; the diff is stale, try again next round
+                return None
+            self.index_meta.load(metadata)   # cheap (no vectors): resync filters wholesale
+            if missing or extra_logo or extra_text:
+                repaired, _ = self._apply_changes(snapshot, extra_logo | set(logo_vecs),
+                                                  {'logo': logo_vecs, 'text': text_vecs},
+                                                  remove_text=extra_text | set(text_vecs))
+                if repaired is None:
+                    self._rebuild_in_background("consistency check found stale ids in an HNSW index")
+                    return None
+                self._publish(repaired)
+                print(f"FAISS consistency check repaired: logos +{len(logo_vecs)}/-{len(extra_logo)}, "
+                      f"texts +{len(text_vecs)}/-{len(extra_text)}.")
+            snapshot = self._snapshot
+
+        # Each index is only persisted if its table did not move during the check
+        entries = []
+        if version is not None and version == self._dataset_version():
+            entries += [('logo', snapshot.logo_index, version), ('text', snapshot.text_index, version)]
+        if component_version is not None and component_version == self._dataset_version('logo_components'):
+            entries.append(('components', snapshot.component_index, component_version))
+        self._save_indexes(entries)
+        return {'logo_added': len(logo_vecs), 'logo_removed': len(extra_logo),
+                'text_added': len(text_vecs), 'text_removed': len(extra_text)}
+
+    def start_consistency_checks(self, interval=None):
+        """Runs check_index_consistency every INDEX_CHECK_INTERVAL seconds (0 disables) in a daemon thread."""
+        interval = float(interval if interval is not None else os.getenv('INDEX_CHECK_INTERVAL', 300))
+        if interval <= 0 or (self._check_thread is not None and self._check_thread.is_alive()):
+            return self._check_thread
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.check_index_consistency()
+                except Exception as e:
+                    print(f"FAISS consistency check failed: {e}")
 
-        if query_embedding.ndim == 1:
-            query_embedding = np.expand_dims(query_embedding, axis=0).astype('float32')
+        self._check_thread = threading.Thread(target=loop, daemon=True, name="index-check")
+        self._check_thread.start()
+        return self._check_thread
 
+    def _prepare_query(self, index, query_embedding, category, classes, batch_number, batch_year, components=False):
+        """Normalized (1, dim) query plus the filter's SearchParameters; params is False if nothing can match."""
+        allowed = self.index_meta.select(category, classes, batch_number, batch_year)
+        if allowed is not None and not len(allowed):
+            return None, False
+        if allowed is not None and components:
+            # Only the first max_components slots of a mark are ever written
+            allowed = (allowed[:, None] * COMPONENT_SLOTS + np.arange(self.max_components, dtype='int64')).ravel()
+
+        query = np.array(query_embedding, dtype='float32').reshape(1, -1)
         # Normalize the query to match the indexed vectors
-        faiss.normalize_L2(query_embedding)
+        faiss.normalize_L2(query)
 
-        num_results_to_fetch = 10
-        similarities, found_ids = self.logo_index.search(query_embedding, num_results_to_fetch)
+        search_params = None
+        if allowed is not None:
+            search_params = filtered_search_params(index, self.index_params, allowed, index.ntotal)
+        return query, search_params
 
-        id_list = [int(i) for i in found_ids[0] if i != -1]
+    def search_logo_index(self, query_embedding, return_distances=False,
+                          category=None, classes=None, batch_number=None, batch_year=None, k=10):
+        """
+        Searches the FAISS index. 
+        Returns high similarity scores (0.90+) for similar images like G813/G814.
+        category / classes / batch filters are applied inside FAISS, so the top k are the
+        best matches within the filter rather than the global top k filtered afterwards.
+        """
+        with self._index_rw.read():
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.logo_index.ntotal == 0:
+                print("Error: FAISS logo index is not built.")
+                return ([], []) if return_distances else []
+            query, search_params = self._prepare_query(snapshot.logo_index, query_embedding, category, classes, batch_number, batch_year)
+            if search_params is False:
+                return ([], []) if return_distances else []
+            similarities, found_ids = snapshot.logo_index.search(query, k, params=search_params)
+
+        # Padding slots (-1) are dropped from both lists so distances stay aligned with ids
+        hits = [(float(sim), int(i)) for sim, i in zip(similarities[0], found_ids[0]) if i != -1]
+        id_list = [i for _, i in hits]
         
         if return_distances:
-            # similarities[0] contains the Cosine Similarity (1.0 = perfect)
+            # similarities contain the Cosine Similarity (1.0 = perfect)
             # We convert to "Distance" where 0.0 = perfect for the logic in app.py
-            distances = [float(1.0 - sim) for sim in similarities[0]]
+            distances = [1.0 - sim for sim, _ in hits]
             return distances, id_list
         else:
-            return id_list
\ No newline at end of file
+            return id_list
+
+    def range_search_logo_index(self, query_embedding, threshold=0.90, limit=None, offset=0,
+                                category=None, classes=None, batch_number=None, batch_year=None):
+        """
+        Range mode: every logo with cosine similarity above `threshold` (best first) instead of a
+        fixed top k. At most SEARCH_MAX_RESULTS hits are kept; offset / limit page through them.
+        Returns {'ids', 'similarities', 'total', 'truncated'} for the requested page.
+        """
+        page = {'ids': [], 'similarities': [], 'total': 0, 'truncated': False}
+        cap = max_search_results()
+        with self._index_rw.read():
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.logo_index.ntotal == 0:
+                print("Error: FAISS logo index is not built.")
+                return page
+            query, search_params = self._prepare_query(snapshot.logo_index, query_embedding, category, classes, batch_number, batch_year)
+            if search_params is False:
+                return page
+            # One extra hit tells us whether the cap cut the result set short
+            sims, ids = range_search(snapshot.logo_index, query, threshold, cap + 1, search_params)[0]
+
+        page['total']     = int(min(len(ids), cap))
+        page['truncated'] = bool(len(ids) > cap)
+        end = page['total'] if limit is None else min(page['total'], offset + limit)
+        page['ids']          = [int(i) for i in ids[offset:end]]
+        page['similarities'] = [float(v) for v in sims[offset:end]]
+        return page
+
+    def search_text_index(self, query, k=10, threshold=None,
+                          category=None, classes=None, batch_number=None, batch_year=None):
+        """
+        Semantic search over the stored text (name + goods/services) embeddings.
+        query is a string (embedded once) or a 384-dim vector. Returns (similarities, ids),
+        best first: the top k, or with a threshold every hit above it (capped at k).
+        """
+        if self.text_index is None or self.text_index.ntotal == 0:
+            print("Error: FAISS text index is not built.")
+            return [], []
+        if isinstance(query, str):
+            query = self.generate_text_embedding(query)
+        if not np.any(query):
+            return [], []
+
+        with self._index_rw.read():
+            text_index = self._snapshot.text_index
+            query, search_params = self._prepare_query(text_index, query, category, classes, batch_number, batch_year)
+            if search_params is False:
+                return [], []
+            if threshold is not None:
+                sims, ids = range_search(text_index, query, threshold, k, search_params)[0]
+            else:
+                sims, ids = text_index.search(query, k, params=search_params)
+                sims, ids = sims[0][ids[0] != -1], ids[0][ids[0] != -1]
+        return [float(v) for v in sims], [int(i) for i in ids]
+
+    def search_logo_components(self, query_embedding, k=10, threshold=None, aggregate='max',
+                               category=None, classes=None, batch_number=None, batch_year=None):
+        """
+        Searches the per-component logo index (LOGO_COMPONENTS=True) and folds the hits back
+        onto their trademarks: a mark scores its best component ('max') or the sum of its
+        matching components ('sum', capped at 1.0). Returns (scores, trademark ids), best first.
+        """
+        with self._index_rw.read():
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.component_index is None or snapshot.component_index.ntotal == 0:
+                return [], []
+            index = snapshot.component_index
+            query, search_params = self._prepare_query(index, query_embedding, category, classes,
+                                                       batch_number, batch_year, components=True)
+            if search_params is False:
+                return [], []
+            # Several components of one mark can hit, so over-fetch before grouping
+            fetch = k * self.max_components
+            if threshold is not None:
+                sims, ids = range_search(index, query, threshold, max(fetch, max_search_results()), search_params)[0]
+            else:
+                sims, ids = index.search(query, fetch, params=search_params)
+                sims, ids = sims[0][ids[0] != -1], ids[0][ids[0] != -1]
+
+        scores = {}
+        for sim, cid in zip(sims, ids):
+            tm_id = int(cid) // COMPONENT_SLOTS
+            if aggregate == 'sum':
+                scores[tm_id] = scores.get(tm_id, 0.0) + float(sim)
+            else:
+                scores[tm_id] = max(scores.get(tm_id, -1.0), float(sim))
+        ranked = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)[:k]
+        return [min(score, 1.0) for _, score in ranked], [tm_id for tm_id, _ in ranked]
@@ -0,0 +1,277 @@
+# onnx_backend.py
+"""
+ONNX Runtime CPU backend for CLIP (images) and MiniLM (text), optionally int8-quantized.
+
+Export once (needs torch + sentence-transformers + onnxruntime):
+    python onnx_backend.py export --out models/onnx
+Check cosine drift and throughput against the PyTorch backend:
+    python onnx_backend.py parity --out models/onnx
+Serve with it:
+    ML_BACKEND=onnx ONNX_MODEL_DIR=models/onnx ONNX_QUANTIZED=True
+
+At serve time only onnxruntime and transformers (tokenizer / image processor) are needed.
+The exported graphs reproduce the SentenceTransformer outputs (CLIP image features,
+MiniLM mean pooling), so vectors stay compatible with embeddings stored by the torch path.
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+# Optional dependency
+try:
+    import onnxruntime as ort
+    _HAS_ORT = True
+except Exception:
+    ort = None
+    _HAS_ORT = False
+
+IMAGE_FILE      = "clip_image.onnx"
+TEXT_FILE       = "minilm_text.onnx"
+PROCESSOR_DIR   = "clip_processor"
+TOKENIZER_DIR   = "minilm_tokenizer"
+META_FILE       = "meta.json"
+
+def _quantized_name(filename):
+    return filename.replace(".onnx", ".int8.onnx")
+
+# ==============================================================================
+# EXPORT
+# ==============================================================================
+
+def export_models(out_dir, image_model_name="clip-ViT-B-32", text_model_name="all-MiniLM-L6-v2",
+                  quantize=True, opset=17):
+    """Exports both SentenceTransformer models to ONNX (plus int8 copies when quantize=True)."""
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    # --- CLIP: vision tower + projection, i.e. what SentenceTransformer.encode(images) returns ---
+    clip_st     = SentenceTransformer(image_model_name, device="cpu")
+    clip_module = clip_st[0]
+    processor   = clip_module.processor.image_processor
+    crop        = processor.crop_size
+    image_size  = crop["height"] if isinstance(crop, dict) else int(crop)
+
+    class _ImageEncoder(torch.nn.Module):
+        def __init__(self, clip):
+            super().__init__()
+            self.clip = clip
+
+        def forward(self, pixel_values):
+            return self.clip.get_image_features(pixel_values=pixel_values)
+
+    image_path = os.path.join(out_dir, IMAGE_FILE)
+    torch.onnx.export(
+        _ImageEncoder(clip_module.model).eval(),
+        (torch.zeros(1, 3, image_size, image_size),),
+        image_path,
+        input_names=["pixel_values"],
+        output_names=["image_embeds"],
+        dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+        opset_version=opset,
+    )
+    processor.save_pretrained(os.path.join(out_dir, PROCESSOR_DIR))
+    print(f"[ONNX] Exported {image_model_name} -> {image_path}")
+
+    # --- MiniLM: transformer only; mean pooling is done in numpy like the Pooling module ---
+    text_st     = SentenceTransformer(text_model_name, device="cpu")
+    transformer = text_st[0].auto_model.eval()
+    tokenizer   = text_st.tokenizer
+    dummy       = tokenizer(["export"], return_tensors="pt")
+    input_names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in dummy]
+
+    class _TextEncoder(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, *inputs):
+            return self.model(**dict(zip(input_names, inputs))).last_hidden_state
+
+    text_path = os.path.join(out_dir, TEXT_FILE)
+    dynamic = {n: {0: "batch", 1: "sequence"} for n in input_names}
+    dynamic["last_hidden_state"] = {0: "batch", 1: "sequence"}
+    torch.onnx.export(
+        _TextEncoder(transformer),
+        tuple(dummy[n] for n in input_names),
+        text_path,
+        input_names=input_names,
+        output_names=["last_hidden_state"],
+        dynamic_axes=dynamic,
+        opset_version=opset,
+    )
+    tokenizer.save_pretrained(os.path.join(out_dir, TOKENIZER_DIR))
+    print(f"[ONNX] Exported {text_model_name} -> {text_path}")
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        for path in (image_path, text_path):
+            qpath = _quantized_name(path)
+            quantize_dynamic(path, qpath, weight_type=QuantType.QInt8)
+            print(f"[ONNX] Quantized int8 -> {qpath}")
+
+    with open(os.path.join(out_dir, META_FILE), "w") as f:
+        json.dump({
+            "image_model":    image_model_name,
+            "text_model":     text_model_name,
+            "max_seq_length": text_st.max_seq_length,
+            "quantized":      quantize,
+        }, f, indent=2)
+
+# ==============================================================================
+# RUNTIME BACKEND
+# ==============================================================================
+
+class OnnxBackend:
+    """Same interface as ml_utils.TorchBackend, backed by onnxruntime InferenceSessions."""
+    name = "onnx"
+
+    def __init__(self, model_dir="models/onnx", quantized=True, threads=None):
+        self.model_dir = model_dir
+        self.quantized = quantized
+        self.threads   = threads or int(os.getenv("ONNX_THREADS", 0)) or None
+        self.image_session = None
+        self.text_session  = None
+        self.image_processor = None
+        self.tokenizer = None
+        self.max_seq_length = 256
+
+    def _path(self, filename):
+        path = os.path.join(self.model_dir, filename)
+        if self.quantized:
+            qpath = _quantized_name(path)
+            if os.path.exists(qpath):
+                return qpath
+            print(f"[ONNX] No int8 model at {qpath}, using float32 graph.")
+        return path
+
+    def load(self):
+        if not _HAS_ORT:
+            raise RuntimeError("onnxruntime not installed")
+        from transformers import AutoTokenizer, CLIPImageProcessor
+
+        meta_path = os.path.join(self.model_dir, META_FILE)
+        if not os.path.exists(meta_path):
+            raise RuntimeError(f"No exported ONNX models in {self.model_dir}; run 'python onnx_backend.py export'.")
+        with open(meta_path) as f:
+            self.max_seq_length = json.load(f).get("max_seq_length", 256)
+
+        opts = ort.SessionOptions()
+        if self.threads:
+            opts.intra_op_num_threads = self.threads
+        providers = ["CPUExecutionProvider"]
+        self.image_session = ort.InferenceSession(self._path(IMAGE_FILE), opts, providers=providers)
+        self.text_session  = ort.InferenceSession(self._path(TEXT_FILE), opts, providers=providers)
+        self.text_inputs   = [i.name for i in self.text_session.get_inputs()]
+
+        self.image_processor = CLIPImageProcessor.from_pretrained(os.path.join(self.model_dir, PROCESSOR_DIR))
+        self.tokenizer       = AutoTokenizer.from_pretrained(os.path.join(self.model_dir, TOKENIZER_DIR))
+
+    def encode_images(self, images, batch_size):
+        out = []
+        for start in range(0, len(images), batch_size):
+            chunk  = images[start:start + batch_size]
+            pixels = self.image_processor(images=chunk, return_tensors="np")["pixel_values"].astype(np.float32)
+            out.append(self.image_session.run(None, {"pixel_values": pixels})[0])
+        return np.vstack(out) if out else np.zeros((0, 512), dtype=np.float32)
+
+    def encode_texts(self, texts, batch_size):
+        out = []
+        for start in range(0, len(texts), batch_size):
+            tokens = self.tokenizer(texts[start:start + batch_size], padding=True, truncation=True,
+                                    max_length=self.max_seq_length, return_tensors="np")
+            feed   = {n: tokens[n].astype(np.int64) for n in self.text_inputs}
+            hidden = self.text_session.run(None, feed)[0]
+            # Mean pooling over real tokens, as in sentence_transformers.models.Pooling
+            mask = tokens["attention_mask"][..., None].astype(np.float32)
+            out.append((hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None))
+        return np.vstack(out) if out else np.zeros((0, 384), dtype=np.float32)
+
+# ==============================================================================
+# PARITY & THROUGHPUT CHECK
+# ==============================================================================
+
+SAMPLE_TEXTS = [
+    "Clothing, footwear, headgear",
+    "Coffee, tea, cocoa and artificial coffee; rice; bread, pastry and confectionery",
+    "Pharmaceutical and veterinary preparations; dietetic substances adapted for medical use",
+    "Advertising; business management; business administration; office functions",
+    "Computer software; downloadable mobile applications; scientific apparatus",
+    "Restaurant services; cafe services; catering services for the provision of food and drinks",
+]
+
+def _cosine_rows(a, b):
+    a = a / np.clip(np.linalg.norm(a, axis=1, keepdims=True), 1e-12, None)
+    b = b / np.clip(np.linalg.norm(b, axis=1, keepdims=True), 1e-12, None)
+    return (a * b).sum(axis=1)
+
+def _timed(fn, items, batch_size, repeats):
+    fn(items[:batch_size], batch_size)  # warm-up run, excluded from timing
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = fn(items, batch_size)
+    elapsed = time.perf_counter() - start
+    return result, (len(items) * repeats) / elapsed if elapsed else float("inf")
+
+def parity_check(model_dir="models/onnx", quantized=True, image_glob="trademarks/*.png",
+                 texts=None, batch_size=32, repeats=3):
+    """
+    Encodes the same images/texts with the torch and ONNX backends.
+    Reports cosine drift (1 - cosine similarity) and items/second for both.
+    """
+    from ml_utils import TorchBackend
+
+    images = [Image.open(p).convert("RGB") for p in sorted(glob.glob(image_glob))]
+    texts  = texts or SAMPLE_TEXTS
+    if not images:
+        raise RuntimeError(f"No images matched {image_glob}")
+
+    with open(os.path.join(model_dir, META_FILE)) as f:
+        meta = json.load(f)
+    torch_backend = TorchBackend(meta["image_model"], meta["text_model"])
+    onnx_backend  = OnnxBackend(model_dir=model_dir, quantized=quantized)
+    torch_backend.load()
+    onnx_backend.load()
+
+    report = {}
+    for kind, items, t_fn, o_fn in (
+        ("image", images, torch_backend.encode_images, onnx_backend.encode_images),
+        ("text",  texts,  torch_backend.encode_texts,  onnx_backend.encode_texts),
+    ):
+        ref, torch_ips = _timed(t_fn, items, batch_size, repeats)
+        got, onnx_ips  = _timed(o_fn, items, batch_size, repeats)
+        drift = 1.0 - _cosine_rows(np.asarray(ref, dtype=np.float32), np.asarray(got, dtype=np.float32))
+        report[kind] = {
+            "items":            len(items),
+            "mean_drift":       float(drift.mean()),
+            "max_drift":        float(drift.max()),
+            "torch_items_per_s": round(torch_ips, 1),
+            "onnx_items_per_s":  round(onnx_ips, 1),
+            "speedup":           round(onnx_ips / torch_ips, 2) if torch_ips else None,
+        }
+
+    print(f"--- ONNX parity ({'int8' if quantized else 'fp32'}) vs PyTorch ---")
+    for kind, r in report.items():
+        print(f"{kind:>5}: n={r['items']:<4} drift mean={r['mean_drift']:.5f} max={r['max_drift']:.5f} | "
+              f"torch {r['torch_items_per_s']}/s  onnx {r['onnx_items_per_s']}/s  (x{r['speedup']})")
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export / verify ONNX versions of the MarkLogic embedding models.")
+    parser.add_argument("command", choices=["export", "parity"])
+    parser.add_argument("--out", default=os.getenv("ONNX_MODEL_DIR", "models/onnx"))
+    parser.add_argument("--no-quantize", action="store_true", help="export / compare the float32 graphs only")
+    parser.add_argument("--images", default="trademarks/*.png", help="glob of sample logos for the parity check")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_models(args.out, quantize=not args.no_quantize)
+    else:
+        parity_check(args.out, quantized=not args.no_quantize, image_glob=args.images)
@@ -7,19 +7,16 @@ FIXED VERSION: Proper field extraction + logo-only cropping (no left-side text)
 import io
 import os
 import re
+import importlib.util
 import numpy as np
 from PIL import Image
+from index_metadata import nice_classes
 import pdfplumber
 
 
 # Optional dependencies
-# YOLO logo detector
-try:
-    from ultralytics import YOLO
-    _HAS_YOLO = True
-except Exception:
-    YOLO = None
-    _HAS_YOLO = False
+# YOLO logo detector (imported lazily in UltraRobustExtractor: ultralytics pulls in torch)
+_HAS_YOLO = importlib.util.find_spec("ultralytics") is not None
 
 try:
     import cv2
@@ -42,12 +39,6 @@ except Exception:
     faiss = None
     _HAS_FAISS = False
 
-try:
-    from sentence_transformers import SentenceTransformer
-    _HAS_SENTE_TRANS = True
-except Exception:
-    SentenceTransformer = None
-    _HAS_SENTE_TRANS = False
 
 # Progress bar for extraction 
 try:
@@ -59,51 +50,31 @@ except ImportError:
 # MLModel
 # -------------------------
 class MLModel:
+    """
+    Extractor-side wrapper kept for its build/search API. Embeddings come from
+    ml_utils.MLModel, so it honours ML_BACKEND (including the shared sidecar)
+    instead of loading a second copy of the models.
+    """
     def __init__(self, image_model_name="clip-ViT-B-32", text_model_name="all-MiniLM-L6-v2"):
-        print("Loading ML models...")
-        if not _HAS_SENTE_TRANS:
-            raise RuntimeError("sentence_transformers not installed")
-        self.image_model = SentenceTransformer(image_model_name)
-        self.text_model = SentenceTransformer(text_model_name)
+        from ml_utils import MLModel as SharedModel
+        self.shared = SharedModel(image_model_name=image_model_name, text_model_name=text_model_name)
+        self.shared.load_models()
         self.logo_index = None
         self.id_map = []
-        print("ML models loaded successfully.")
 
     def generate_image_embedding(self, image_file_stream):
         try:
-            if isinstance(image_file_stream, (bytes, bytearray)):
-                image = Image.open(io.BytesIO(image_file_stream)).convert("RGB")
-            elif hasattr(image_file_stream, "read"):
-                image = Image.open(image_file_stream).convert("RGB")
-            else:
-                image = Image.open(image_file_stream).convert("RGB")
-
-            emb = self.image_model.encode([image], convert_to_numpy=True, show_progress_bar=False)[0]
-            norm = np.linalg.norm(emb)
-            if norm > 0:
-                emb = emb / norm
-            return emb.astype("float32")
+            return self.shared.generate_image_embedding(image_file_stream)
         except Exception as e:
             print(f"[MLModel] Error generating image embedding: {e}")
             return None
 
     def generate_text_embedding(self, text):
         try:
-            if not text:
-                dim = self.text_model.get_sentence_embedding_dimension()
-                return np.zeros(dim, dtype="float32")
-            emb = self.text_model.encode(text, convert_to_numpy=True, show_progress_bar=False)
-            norm = np.linalg.norm(emb)
-            if norm > 0:
-                emb = emb / norm
-            return emb.astype("float32")
+            return self.shared.generate_text_embedding(text)
         except Exception as e:
             print(f"[MLModel] Error generating text embedding: {e}")
-            try:
-                dim = self.text_model.get_sentence_embedding_dimension()
-                return np.zeros(dim, dtype="float32")
-            except Exception:
-                return np.zeros(384, dtype="float32")
+            return np.zeros(384, dtype="float32")
 
     def build_logo_index(self, db_fetch_fn):
         if not _HAS_FAISS:
@@ -176,6 +147,7 @@ class UltraRobustExtractor:
 
         if _HAS_YOLO and os.path.exists(yolo_model_path):
             try:
+                from ultralytics import YOLO
                 self.yolo = YOLO(yolo_model_path)
                 print(f"[Extractor] YOLO model loaded: {yolo_model_path}")
             except Exception as e:
@@ -775,6 +747,7 @@ class UltraRobustExtractor:
             "registration_date": fields["registration_date"],
             "trademark_name": fields["trademark_name"],
             "class_indices": fields["class_indices"],
+            "class_numbers": nice_classes(fields["class_indices"]),
             "applicant_name": fields["applicant_name"],
             "applicant_address": fields["applicant_address"],
             "agent_details": fields["agent_details"],
@@ -823,8 +796,11 @@ class UltraRobustExtractor:
     #         print(f"Total Records Found: {len(results)}")
     #     return results
     
-    def extract_all(self, pdf_stream, start_page=4):
-        results = []
+    def extract_pages(self, pdf_stream, start_page=4):
+        """
+        Yields one progress update per page, carrying the records found on that page
+        under "records". Lets callers start embedding/inserting before the PDF is finished.
+        """
         with pdfplumber.open(pdf_stream) as pdf:
             total_pdf_pages = len(pdf.pages)
             pages_to_process = pdf.pages[start_page - 1:]
@@ -844,26 +820,32 @@ class UltraRobustExtractor:
             for i, page in iterator:
                 # Calculate the actual page number for display
                 pnum = i + start_page 
+                page_records = []
                 
                 try:
-                    # Calculate progress percentage (i+1 because i starts at 0)
-                    progress = int(((i + 1) / total_to_process) * 100)
-                    
-                    # YIELD progress update to the caller (Flask/JS)
-                    yield {"status": "extracting", "percentage": progress, "current_page": pnum}
-
                     blocks = self.find_blocks(page)
                     for block in blocks:
                         data = self.extract_from_block(page, block, pnum)
                         if data:
-                            results.append(data)
+                            page_records.append(data)
                     
                     if not _HAS_TQDM and pnum % 5 == 0:
                         print(f"Currently on page {pnum}...")
 
                 except Exception as e:
                     self.log(f"❌ Page {pnum} failed: {e}")
-                    
+
+                # Calculate progress percentage (i+1 because i starts at 0)
+                progress = int(((i + 1) / total_to_process) * 100)
+                yield {"status": "extracting", "percentage": progress, "current_page": pnum, "records": page_records}
+
+    def extract_all(self, pdf_stream, start_page=4):
+        results = []
+        for update in self.extract_pages(pdf_stream, start_page=start_page):
+            results.extend(update.pop("records"))
+            # YIELD progress update to the caller (Flask/JS)
+            yield update
+
         # Final yield with total results
         yield {"status": "extraction_complete", "results": results}
 
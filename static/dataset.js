@@ -243,17 +243,21 @@ if (uploadBtn) {
                     if (!line.trim()) continue;
                     try {
                         const data = JSON.parse(line);
-                        if (data.status === "extracting") {
+                        if (["extracting", "embedding", "inserting"].includes(data.status)) {
+                            // Stages run concurrently; the bar tracks the slowest one
+                            const st = data.stages || {};
+                            const ex = st.extracting || {};
+                            const em = st.embedding  || {};
+                            const ins = st.inserting || {};
                             progressBar.style.width   = `${data.percentage}%`;
                             progressPercent.innerText = `${data.percentage}%`;
-                            progressText.innerText    = `AI reading PDF: Page ${data.current_page}`;
-                            uploadBtn.innerText       = `⏳ Extracting... ${data.percentage}%`;
-                        } else if (data.status === "inserting") {
-                            progressBar.style.backgroundColor = "#2ecc71";
-                            progressBar.style.width   = `${data.percentage}%`;
-                            progressPercent.innerText = `${data.percentage}%`;
-                            progressText.innerText    = `Saving to DB: ${data.current} of ${data.total}`;
-                            uploadBtn.innerText       = `💾 Saving... ${data.percentage}%`;
+                            if (ex.done) progressBar.style.backgroundColor = "#2ecc71";
+                            progressText.innerText    = ex.done
+                                ? `Saving to DB: ${ins.current} of ${ins.total}`
+                                : `AI reading PDF: Page ${ex.current_page} · Embedded ${em.current} · Saved ${ins.current} of ${ins.total} found`;
+                            uploadBtn.innerText       = ex.done
+                                ? `💾 Saving... ${data.percentage}%`
+                                : `⏳ Extracting... ${ex.percentage}%`;
                         } else if (data.status === "complete") {
                             showPopup(`✅ ${data.message}`);
                             selectedFiles = [];
@@ -324,12 +328,12 @@ function makeDescCell(description) {
 // =============================
 // === MANAGE TAB — RENDER ===
 // =============================
-function renderManageTable(trademarks) {
+function renderManageTable(trademarks, append = false) {
     const tbody = document.getElementById("fileTableBody");
     if (!tbody) return;
-    tbody.innerHTML = "";
+    if (!append) tbody.innerHTML = "";
 
-    if (!trademarks || trademarks.length === 0) {
+    if (!append && (!trademarks || trademarks.length === 0)) {
         tbody.innerHTML = `<tr><td colspan="6" style="text-align:center;padding:20px;opacity:0.6;">No records found.</td></tr>`;
         return;
     }
@@ -396,31 +400,56 @@ function renderManageTable(trademarks) {
 // =============================
 // === MANAGE TAB — LOAD ===
 // =============================
+// Keyset paging: each page starts below the last id shown (next_after from the server)
+const MANAGE_PAGE_SIZE = 100;
+let managePager = { params: new URLSearchParams(), nextAfter: null, loading: false };
+
 async function loadTrademarks({ batch = null, year = null } = {}) {
     const tbody = document.getElementById("fileTableBody");
     if (tbody) {
         tbody.innerHTML = `<tr><td colspan="6" style="text-align:center;padding:20px;">Loading…</td></tr>`;
     }
 
-    const params = new URLSearchParams();
+    const params = new URLSearchParams({ limit: MANAGE_PAGE_SIZE });
     if (batch) params.append("batch_number", batch);
     if (year)  params.append("batch_year",   year);
 
+    managePager = { params, nextAfter: null, loading: false };
+    await loadManagePage(managePager, true);
+}
+
+async function loadManagePage(pager, first = false) {
+    if (pager.loading || (!first && !pager.nextAfter)) return;
+    const params = new URLSearchParams(pager.params);
+    if (!first) params.set("after", pager.nextAfter);
+    pager.loading = true;
+
     try {
         const res = await fetch("/api/trademarks?" + params.toString());
         if (!res.ok) { showPopup("Failed to fetch records from server.", true); return; }
         const payload = await res.json();
+        if (pager !== managePager) return;   // filters changed while this page was loading
         if (payload.success) {
-            renderManageTable(payload.trademarks);
+            renderManageTable(payload.trademarks, !first);
+            pager.nextAfter = payload.next_after;
         } else {
             showPopup("Error fetching data from server.", true);
         }
     } catch (err) {
         console.error("Fetch error:", err);
         showPopup("Server error while fetching records.", true);
+    } finally {
+        pager.loading = false;
     }
 }
 
+window.addEventListener("scroll", () => {
+    if (!managePager.nextAfter || !document.getElementById("fileTableBody")) return;
+    if (window.innerHeight + window.scrollY >= document.body.offsetHeight - 400) {
+        loadManagePage(managePager);
+    }
+});
+
 // =============================
 // === SELECT ALL CHECKBOX ===
 // =============================
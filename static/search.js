@@ -8,8 +8,17 @@ document.addEventListener('DOMContentLoaded', () => {
     const resultsBody = document.getElementById('resultsBody');
     const wordsInput = document.getElementById('wordsInput');
     const classInput = document.getElementById('classInput');
+    const modeInput = document.getElementById('modeInput');
     let uploadedFile = null;
 
+    // Keyset paging state for text searches: the next page starts below `nextAfter`
+    const PAGE_SIZE = 50;
+    let pager = {
+        query: { limit: PAGE_SIZE },
+        nextAfter: resultsBody.dataset.nextAfter || null,
+        loading: false
+    };
+
     // =========================================================================
     // YOUR EXISTING FILE UPLOAD & DRAG-AND-DROP LOGIC (UNCHANGED)
     // =========================================================================
@@ -82,11 +91,11 @@ document.addEventListener('DOMContentLoaded', () => {
     // =========================================================================
     // NEW DYNAMIC TABLE UPDATE FUNCTION
     // =========================================================================
-    const updateTable = (trademarks) => {
-        resultsBody.innerHTML = '';
+    const updateTable = (trademarks, append = false) => {
+        if (!append) resultsBody.innerHTML = '';
         
         // Check if there is data
-        if (!trademarks || trademarks.length === 0) {
+        if (!append && (!trademarks || trademarks.length === 0)) {
             resultsBody.innerHTML = '<tr><td colspan="6" style="text-align:center; padding: 20px;">No results found.</td></tr>';
             return;
         }
@@ -97,7 +106,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 ? `<div class="trademark-image"><img src="/logo/${trademark.id}" alt="Logo"></div>`
                 : `<div class="trademark-image no-logo"><span>No Logo</span></div>`;
 
-            // 2. Build the 6-column row
+            // 2. Build the 6-column row (full-text hits show their highlighted snippet: server-escaped HTML)
             const rowHtml = `
                 <tr>
                     <td class="trademark-cell">${logoHtml}</td>
@@ -105,7 +114,7 @@ document.addEventListener('DOMContentLoaded', () => {
                     <td class="id-cell">${trademark.serial_number || 'N/A'}</td>
                     <td>${trademark.applicant_name || 'N/A'}</td>
                     <td>${trademark.agent_details || 'N/A'}</td>
-                    <td>${trademark.description || 'N/A'}</td>
+                    <td>${trademark.snippet || trademark.description || 'N/A'}</td>
                 </tr>`;
             
             resultsBody.insertAdjacentHTML('beforeend', rowHtml);
@@ -124,19 +133,28 @@ document.addEventListener('DOMContentLoaded', () => {
         resultsSection.classList.add('show');
         resultsBody.innerHTML = '<tr><td colspan="6" style="text-align:center;">Searching...</td></tr>';
 
-        let endpoint = '/api/text_search';
-
-        if (uploadedFile) {
-            formData.append('image', uploadedFile);
-            endpoint = '/api/image_search';
+        if (!uploadedFile) {
+            // Text searches are paged: first page now, the rest as the user scrolls
+            const query = { words, class_filter: classFilter, mode: modeInput ? modeInput.value : 'substring', limit: PAGE_SIZE };
+            pager = { query, nextAfter: null, loading: false };
+            loadNextPage(true);
+            return;
         }
 
+        pager = { query: { limit: PAGE_SIZE }, nextAfter: null, loading: false };
+        formData.append('image', uploadedFile);
+        const endpoint = '/api/image_search';
+
         fetch(endpoint, {
             method: 'POST',
             body: formData // No headers needed, browser handles boundary for FormData
         })
         .then(response => response.json())
         .then(data => {
+            if (data && data.error) {
+                resultsBody.innerHTML = `<tr><td colspan="6" style="text-align:center; padding: 20px;">${data.error}</td></tr>`;
+                return;
+            }
             updateTable(data);
             resultsSection.scrollIntoView({ behavior: 'smooth', block: 'start' });
         })
@@ -145,4 +163,44 @@ document.addEventListener('DOMContentLoaded', () => {
             resultsBody.innerHTML = '<tr><td colspan="6">Error connecting to server.</td></tr>';
         });
     });
+
+    // =========================================================================
+    // PAGING (keyset in ranking order via /api/text_search)
+    // =========================================================================
+    function loadNextPage(first = false) {
+        if (pager.loading || (!first && !pager.nextAfter)) return;
+        const current = pager;
+        // Sending `after` (empty for the first page) makes /api/text_search return a page + next_after
+        const body = Object.assign({}, current.query, { after: first ? '' : current.nextAfter });
+        current.loading = true;
+
+        fetch('/api/text_search', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(body)
+        })
+            .then(response => response.json())
+            .then(payload => {
+                if (pager !== current) return;   // a newer search replaced this one
+                if (!payload.success) {
+                    resultsBody.innerHTML = `<tr><td colspan="6" style="text-align:center; padding: 20px;">${payload.error || 'Search failed.'}</td></tr>`;
+                    return;
+                }
+                updateTable(payload.trademarks, !first);
+                current.nextAfter = payload.next_after;
+                if (first) resultsSection.scrollIntoView({ behavior: 'smooth', block: 'start' });
+            })
+            .catch(error => {
+                console.error('Search Error:', error);
+                if (first) resultsBody.innerHTML = '<tr><td colspan="6">Error connecting to server.</td></tr>';
+            })
+            .finally(() => { current.loading = false; });
+    }
+
+    window.addEventListener('scroll', () => {
+        if (!resultsSection.classList.contains('show') || !pager.nextAfter) return;
+        if (window.innerHeight + window.scrollY >= document.body.offsetHeight - 400) {
+            loadNextPage();
+        }
+    });
 });
\ No newline at end of file
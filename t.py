@@ -1,6 +1,9 @@
 # t.py
+import os
 from dotenv import load_dotenv
 load_dotenv()  # MUST come first
+os.environ.setdefault("ML_WARMUP", "False")  # only reads config, no need to load the models
+os.environ.setdefault("DB_CHANGE_LISTENER", "False")  # nor to follow other workers' index writes
 
 from app import app  # now env variables are loaded
 